@@ -0,0 +1,199 @@
+"""End-to-end benchmark of process_messages against a fake Gmail service,
+with stub RTKLIB executables and synthetic RINEX data.
+
+Reports messages per minute, reply latency and per-stage latency
+percentiles, and peak memory.  The stub executables are Python scripts,
+so this runs on POSIX systems only.  For example:
+
+    python benchmark.py --messages 20 --workers 4 --duration 3600 --rate 5
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import synth_utils
+from fake_gmail import FakeGmailService
+from my_constants import PROCESS_SUBJECT, ORIG_CONFIG_FILE, DEMO5_CONFIG_FILE
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+class FakeServiceProvider(object):
+    """Stands in for service_utils.ServiceProvider, handing out the fake service."""
+    def __init__(self, service):
+        self.fake = service
+
+    def service(self):
+        return self.fake
+
+    @contextmanager
+    def borrow_http(self):
+        yield None
+
+
+def add_messages(service, work_dir, args):
+    # each message gets its own data, so the result cache is never hit by accident
+    msg_ids = []
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir)
+    for i in range(args.messages):
+        # the first args.long messages are long ones, all from the same sender
+        long_job = i < args.long
+        attachments = {}
+        for name in ('rover.ubx', 'base.ubx'):
+            filename = os.path.join(data_dir, name)
+            synth_utils.write_obs_file(filename, args.duration * (args.long_factor if long_job else 1),
+                1.0 / args.rate, args.systems, args.sats,
+                marker=name.split('.')[0].upper(), seed=2 * i + len(attachments))
+            with open(filename, 'rb') as f:
+                attachments[name] = f.read()
+        sender = 'heavy@example.com' if long_job else 'user%d@example.com' % (i,)
+        msg_ids.append(service.add_message('%s %d' % (PROCESS_SUBJECT, i), sender, args.body, attachments))
+    shutil.rmtree(data_dir)
+    # unrelated unread mail, which is never processed
+    for i in range(args.noise):
+        service.add_message('Newsletter %d' % (i,), 'news@example.com', 'x' * 2000,
+            {'brochure.pdf': b'%PDF' + b'x' * 100000})
+    return msg_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=10, help='number of messages to process')
+    parser.add_argument('--workers', type=int, default=None, help='worker threads (default MAX_WORKERS)')
+    parser.add_argument('--duration', type=float, default=1800, help='seconds of observations per file')
+    parser.add_argument('--long', type=int, default=0, help='number of long messages from one sender, sent first')
+    parser.add_argument('--long-factor', type=float, default=10, help='times longer the long messages are')
+    parser.add_argument('--noise', type=int, default=0, help='number of unrelated unread messages')
+    parser.add_argument('--rate', type=float, default=1.0, help='observation rate in Hz')
+    parser.add_argument('--systems', type=int, default=2, help='number of constellations')
+    parser.add_argument('--sats', type=int, default=8, help='satellites per constellation')
+    parser.add_argument('--convbin', type=float, default=0.5, help='seconds per stub convbin run')
+    parser.add_argument('--rnx2rtkp', type=float, default=2.0, help='seconds per stub rnx2rtkp run')
+    parser.add_argument('--rnx2rtkp-per-epoch', type=float, default=0, help='extra rnx2rtkp seconds per epoch')
+    parser.add_argument('--rtkplot', type=float, default=0.5, help='seconds per stub rtkplot run')
+    parser.add_argument('--rtkplot-exe', action='store_true', help='plot with the stub rtkplot, not natively')
+    parser.add_argument('--body', default='', help='body of each message, for config settings')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='use the asyncio engine')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake Gmail round trip')
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for all replies')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args()
+
+    # gmail_check keeps its runs and job database relative to the working directory
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='rtklib_bench_')
+    for config in (ORIG_CONFIG_FILE, DEMO5_CONFIG_FILE):
+        shutil.copy(os.path.join(repo_dir, config), work_dir)
+    os.chdir(work_dir)
+    bin_dir = os.path.join(work_dir, 'bin')
+    synth_utils.write_stub_tools(bin_dir, args.convbin, args.rnx2rtkp, args.rnx2rtkp_per_epoch, args.rtkplot,
+        num_systems=args.systems, sats_per_system=args.sats)
+
+    # gmail_check parses the command line for the oauth flags when it is imported
+    sys.argv = sys.argv[:1]
+    import gmail_check
+    service = FakeGmailService(latency=args.latency)
+    gmail_check.service_provider = FakeServiceProvider(service)
+    gmail_check.ORIG_BIN_DIR = gmail_check.DEMO5_BIN_DIR = bin_dir
+    gmail_check.USE_RESULT_CACHE = False
+    gmail_check.NATIVE_PLOTS = gmail_check.NATIVE_PLOTS and not args.rtkplot_exe
+    gmail_check.DEBUGGING = False
+    gmail_check.metrics.enabled = True
+    # in the working directory, before wait_for_jobs looks at it
+    gmail_check.open_job_store()
+
+    print('Writing %d messages to %s...' % (args.messages, work_dir))
+    msg_ids = add_messages(service, work_dir, args)
+
+    start = time.time()
+    rows = []
+    def wait_for_jobs():
+        while time.time() - start < args.timeout:
+            rows[:] = [row for row in gmail_check.job_store.execute(
+                'SELECT msg_id, status, updated FROM jobs WHERE status IN (?, ?)', (gmail_check.DONE, gmail_check.FAILED))
+                if row[0] in msg_ids]
+            if len(rows) >= len(msg_ids):
+                break
+            time.sleep(0.2)
+        if args.use_async:
+            # which also checks that the engine shuts down cleanly
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    if args.use_async:
+        thread = threading.Thread(target=wait_for_jobs)
+        thread.start()
+        asyncio.run(gmail_check.process_messages_async(service, args.workers))
+        thread.join()
+    else:
+        thread = threading.Thread(target=gmail_check.process_messages, args=(service, args.workers))
+        thread.daemon = True
+        thread.start()
+        wait_for_jobs()
+    elapsed = time.time() - start
+    gmail_check.metrics.export()
+
+    stage_times = {}
+    with open(gmail_check.metrics.jsonl_file) as f:
+        for line in f:
+            event = json.loads(line)
+            if event['metric'] == 'stage_seconds':
+                stage_times.setdefault(event['labels']['stage'], []).append(event['value'])
+    latencies = [updated - start for _, _, updated in rows]
+    num_failed = sum(1 for _, status, _ in rows if status == gmail_check.FAILED)
+
+    print('')
+    print('%d of %d messages finished, %d failed, in %.1f s: %.2f messages per minute' %
+        (len(rows), len(msg_ids), num_failed, elapsed, 60.0 * len(rows) / elapsed))
+    print('reply latency: p50 %.2f s, p95 %.2f s, max %.2f s' %
+        (percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 100)))
+    print('gmail: %d requests in %d round trips, %.1f MB of responses' %
+        (service.num_requests, service.num_round_trips, service.num_bytes / 1e6))
+    print('')
+    print('%-24s %6s %9s %9s %9s' % ('stage', 'count', 'p50 (s)', 'p95 (s)', 'max (s)'))
+    for stage, times in sorted(stage_times.items(), key=lambda item: -sum(item[1])):
+        print('%-24s %6d %9.3f %9.3f %9.3f' % (stage, len(times), percentile(times, 50),
+            percentile(times, 95), percentile(times, 100)))
+    if resource:
+        print('')
+        print('peak rss: %.1f MB, largest tool run: %.1f MB' %
+            (peak_rss_mb(resource.RUSAGE_SELF), peak_rss_mb(resource.RUSAGE_CHILDREN)))
+
+    if not args.keep:
+        os.chdir(repo_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
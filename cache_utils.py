@@ -0,0 +1,123 @@
+"""Content-addressed cache of tool outputs, so that resubmitting the same data
+does not rerun conversions and plots whose inputs have not changed.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from my_constants import CACHE_DIR, CACHE_MAX_BYTES
+
+
+def make_key(files=(), extra=()):
+    """Hash the contents of files and any extra strings into a cache key."""
+    sha = hashlib.sha256()
+    for filename in files:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                sha.update(chunk)
+        sha.update(b'\0')
+    for value in extra:
+        sha.update(str(value).encode('UTF-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def tool_id(exe_dir, exe_name):
+    """String identifying a tool, which changes if the executable is replaced."""
+    exe_file = os.path.join(exe_dir, exe_name)
+    try:
+        st = os.stat(exe_file)
+        return '%s:%d:%d' % (os.path.abspath(exe_file), st.st_size, st.st_mtime)
+    except os.error:
+        return os.path.abspath(exe_file)
+
+
+class ResultCache(object):
+    """Directory of cache entries, each a directory of files named by its key.
+
+    Entries are evicted least recently used first whenever the total size of
+    the cache exceeds max_bytes.
+
+    Args:
+      root: Directory holding the cache.
+      max_bytes: Maximum total size of the cached files.
+    """
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def run(self, key, target_dir, func, select):
+        """Restore the files of an entry into target_dir, or run func and cache
+        the files it produced there.
+
+        Args:
+          key: Key of the entry, from make_key.
+          target_dir: Directory the tool writes its output to.
+          func: Function running the tool.
+          select: Function returning True for the names of the files in
+            target_dir that were produced by func.
+
+        Returns:
+          True if the files came from the cache.
+        """
+        if self.restore(key, target_dir):
+            return True
+        func()
+        self.store(key, [os.path.join(target_dir, filename)
+                         for filename in os.listdir(target_dir) if select(filename)])
+        return False
+
+    def restore(self, key, target_dir):
+        entry = os.path.join(self.root, key)
+        try:
+            for filename in os.listdir(entry):
+                shutil.copy(os.path.join(entry, filename), os.path.join(target_dir, filename))
+            # mark entry as recently used
+            os.utime(entry, None)
+            return True
+        except os.error:
+            # missing, or evicted while being restored
+            return False
+
+    def store(self, key, paths):
+        entry = os.path.join(self.root, key)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        # copy into a temporary directory first so that no one restores a partial entry
+        tmp_entry = tempfile.mkdtemp(dir=self.root, prefix='.tmp')
+        for path in paths:
+            shutil.copy(path, tmp_entry)
+        try:
+            os.rename(tmp_entry, entry)
+        except os.error:
+            # someone else stored the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.root):
+                entry = os.path.join(self.root, name)
+                if name.startswith('.tmp') or not os.path.isdir(entry):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except os.error:
+                    continue
+                total += size
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
@@ -0,0 +1,138 @@
+"""Parse RTKLIB config file templates and render per-job config files from them.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import os
+import re
+import threading
+
+from log_utils import DataException
+
+# option comments list enumerations like "(0:off,1:on)" or "(1:l1,2:l1+l2)", but not
+# bit masks like "(1:gps+2:sbas)", whose labels would hold another number and colon
+ENUM_RE = re.compile(r'\((\d+:[^,():]+(?:,\d+:[^,():]+)*)\)')
+NUMBER_RE = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+# keys look like "pos2-armode"
+KEY_RE = re.compile(r'^[a-z]+\d*-\w+$')
+
+
+def parse_line(line):
+    pos_eq = line.find('=')
+    pos_hash = line.find('#')
+
+    if pos_eq == -1:
+        return None
+    if pos_hash == -1:
+        pos_hash = len(line)
+    if pos_eq > pos_hash:
+        return None
+
+    name = line[:pos_eq].strip()
+    value = line[pos_eq+1:pos_hash].strip()
+
+    return (name, value)
+
+
+class Option(object):
+    """One option of a template, with its type inferred from the template.
+
+    Types are 'enum' (one of choices, or its number), 'number', 'numbers'
+    (comma separated) or 'string' (anything).
+    """
+    def __init__(self, name, value, comment):
+        self.name = name
+        self.value = value
+        self.choices = []
+        self.numbers = []
+        match = ENUM_RE.search(comment)
+        if match:
+            for choice in match.group(1).split(','):
+                number, label = choice.split(':', 1)
+                self.numbers.append(int(number))
+                self.choices.append(label.strip())
+        if value in self.choices:
+            self.type = 'enum'
+        elif NUMBER_RE.match(value):
+            self.type = 'number'
+        elif value and all(NUMBER_RE.match(v.strip()) for v in value.split(',')):
+            self.type = 'numbers'
+        else:
+            self.type = 'string'
+
+    def check(self, value):
+        """Returns an error message if value is not valid for this option, otherwise None."""
+        value = str(value).strip()
+        if self.type == 'enum':
+            if value in self.choices or (value.isdigit() and int(value) in self.numbers):
+                return None
+            return 'Invalid value "%s" for %s, expected one of %s.' % (value, self.name, ', '.join(self.choices))
+        if self.type == 'number' and not NUMBER_RE.match(value):
+            return 'Invalid value "%s" for %s, expected a number.' % (value, self.name)
+        if self.type == 'numbers' and not all(NUMBER_RE.match(v.strip()) for v in value.split(',')):
+            return 'Invalid value "%s" for %s, expected comma separated numbers.' % (value, self.name)
+        return None
+
+
+class ConfigTemplate(object):
+    """Config file parsed once into its lines and options, in file order."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        self.lines = []
+        self.options = {}
+        with open(filename, 'r') as config_template:
+            for line in config_template:
+                nv_tuple = parse_line(line)
+                if nv_tuple:
+                    comment = line[line.find('#'):] if line.find('#') != -1 else ''
+                    self.options[nv_tuple[0]] = Option(nv_tuple[0], nv_tuple[1], comment)
+                    self.lines.append((nv_tuple[0], line))
+                else:
+                    self.lines.append((None, line))
+
+    def render(self, overwrites):
+        """Returns the text of the template with the values of overwrites substituted in."""
+        return ''.join('%s=%s\n' % (name, overwrites[name]) if name in overwrites else line
+                       for name, line in self.lines)
+
+    def write(self, config_file, overwrites):
+        with open(config_file, 'w') as my_config:
+            my_config.write(self.render(overwrites))
+
+
+templates = {}
+templates_lock = threading.Lock()
+
+def get_template(filename):
+    """Returns the parsed template, parsing it again only if the file has changed."""
+    with templates_lock:
+        template = templates.get(filename)
+        if template is None or os.path.getmtime(filename) != template.mtime:
+            template = templates[filename] = ConfigTemplate(filename)
+        return template
+
+
+def check_overwrites(overwrites, template_list):
+    """Check overwrites against the options of the templates.
+
+    Raises DataException for a value that is invalid for its option.
+
+    Returns:
+      List of names of overwrites which look like config options but are
+      not in any of the templates, and so are not used.
+    """
+    unknown = []
+    for name, value in overwrites.items():
+        options = [t.options[name] for t in template_list if name in t.options]
+        if not options:
+            if KEY_RE.match(name):
+                unknown.append(name)
+            continue
+        for option in options:
+            error = option.check(value)
+            if error:
+                raise DataException(error)
+    return sorted(unknown)
@@ -6,6 +6,7 @@
 # terms of the BSD-2-Clause license
 
 import base64
+import email.message
 from email.mime.audio import MIMEAudio
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
@@ -13,10 +14,23 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import mimetypes
 import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from apiclient import errors
+from apiclient.http import MediaFileUpload
 
-from log_utils import log_error
+import log_utils
+from metrics_utils import metrics
+from my_constants import (GMAIL_BATCH_SIZE, GMAIL_BATCH_RETRIES, ATTACHMENT_WORKERS,
+    DECODE_CHUNK_SIZE, RAW_SEND_LIMIT, MEASURE_REPLY_MEMORY)
+
+# http status codes for which a failed request in a batch is tried again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 
 def SendMessage(service, user_id, message):
@@ -124,32 +138,233 @@ def CreateMessageWithAttachments(sender, to, subject, message_text, is_html, att
     return {'raw': base64.urlsafe_b64encode(message.as_bytes())}
 
 
-def GetAttachments(service, user_id, msg_id, dirname):
+def WriteMessageFile(fp, sender, to, subject, message_text, is_html, attachments,
+    thread_id=None, in_reply_to=None, references=None):
+    """Write the same message as CreateMessageWithAttachments to a binary file,
+    base64 encoding the attachments a chunk at a time so that none of them
+    is ever held in memory in full.
+    """
+    boundary = ('===============%s==' % (uuid.uuid4().hex,)).encode('ascii')
+
+    def write_headers(message):
+        for name, value in message.items():
+            fp.write(message.policy.fold_binary(name, value))
+        fp.write(b'\n')
+
+    top = email.message.Message()
+    top['to'] = to
+    top['from'] = sender
+    top['subject'] = subject
+    if thread_id:
+        top['references'] = references
+        top['in-reply-to'] = in_reply_to
+    top['MIME-Version'] = '1.0'
+    top['Content-Type'] = 'multipart/mixed; boundary="%s"' % (boundary.decode('ascii'),)
+    write_headers(top)
+
+    fp.write(b'--' + boundary + b'\n')
+    fp.write(MIMEText(message_text, 'html' if is_html else 'plain').as_bytes())
+    fp.write(b'\n')
+
+    for attachment in attachments or []:
+        filename = os.path.basename(attachment['path'])
+        content_type, encoding = mimetypes.guess_type(attachment['path'])
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+        main_type, sub_type = content_type.split('/', 1)
+        msg = MIMEBase(main_type, sub_type)
+        msg['Content-Transfer-Encoding'] = 'base64'
+        if attachment['disposition'] == 'inline':
+            msg.add_header('Content-Id', '<%s>' % (filename,))
+            msg.add_header('Content-Disposition', 'inline', filename=filename)
+        else:
+            msg.add_header('Content-Disposition', 'attachment', filename=filename)
+
+        fp.write(b'--' + boundary + b'\n')
+        write_headers(msg)
+        with open(attachment['path'], 'rb') as f:
+            # multiples of 57 bytes encode to whole 76 character lines
+            for chunk in iter(lambda: f.read(57 * 1024), b''):
+                fp.write(base64.encodebytes(chunk))
+        fp.write(b'\n')
+
+    fp.write(b'--' + boundary + b'--\n')
+
+
+# traces open at the moment, see MemoryTrace
+memory_traces = []
+memory_traces_lock = threading.Lock()
+# whether tracemalloc was started by MemoryTrace, rather than already running
+memory_tracing_started = False
+
+
+class MemoryTrace(object):
+    """Context manager tracing the peak memory allocated while it is open.
+
+    tracemalloc is process wide, so it is started with the first trace
+    open and stopped after the last one closes.  Allocations of all threads
+    are counted, so peak is left None for a trace which overlapped another.
+
+    Args:
+      enabled: If False, nothing is traced.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.overlapped = False
+        self.peak = None
+
+    def __enter__(self):
+        global memory_tracing_started
+        if not self.enabled:
+            return self
+        with memory_traces_lock:
+            if not memory_traces:
+                if tracemalloc.is_tracing():
+                    tracemalloc.reset_peak()
+                else:
+                    tracemalloc.start()
+                    memory_tracing_started = True
+            for trace in memory_traces:
+                trace.overlapped = True
+            self.overlapped = bool(memory_traces)
+            memory_traces.append(self)
+        return self
+
+    def __exit__(self, *args):
+        global memory_tracing_started
+        if not self.enabled:
+            return
+        with memory_traces_lock:
+            if not self.overlapped:
+                self.peak = tracemalloc.get_traced_memory()[1]
+            memory_traces.remove(self)
+            if not memory_traces and memory_tracing_started:
+                tracemalloc.stop()
+                memory_tracing_started = False
+
+
+def SendMessageWithAttachments(service, user_id, sender, to, subject, message_text, is_html,
+    attachments, thread_id=None, in_reply_to=None, references=None, measure=MEASURE_REPLY_MEMORY):
+    """Create and send a message, uploading it from a temporary file if it is large.
+
+    Messages whose attachments add up to more than RAW_SEND_LIMIT bytes are
+    written out with WriteMessageFile and sent with a resumable media upload.
+    Smaller ones are built in memory and sent as the raw field, as before.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value "me"
+      can be used to indicate the authenticated user.
+      measure: Print the peak memory allocated while sending, unless other
+        replies were being sent at the same time (see MemoryTrace).
+      The other arguments are the same as for CreateMessageWithAttachments.
+
+    Returns:
+      Sent Message.
+    """
+    size = sum(os.path.getsize(attachment['path']) for attachment in attachments or [])
+    with MemoryTrace(measure) as trace:
+        if size <= RAW_SEND_LIMIT:
+            method = 'raw'
+            with metrics.timer('build mime'):
+                message = CreateMessageWithAttachments(sender, to, subject, message_text, is_html,
+                    attachments, thread_id, in_reply_to, references)
+            with metrics.timer('send'):
+                sent = SendMessage(service, user_id, message)
+        else:
+            method = 'upload'
+            fd, path = tempfile.mkstemp(suffix='.eml')
+            media = None
+            try:
+                with metrics.timer('build mime'), os.fdopen(fd, 'wb') as fp:
+                    WriteMessageFile(fp, sender, to, subject, message_text, is_html,
+                        attachments, thread_id, in_reply_to, references)
+                body = {'threadId': thread_id} if thread_id else {}
+                media = MediaFileUpload(path, mimetype='message/rfc822', resumable=True)
+                with metrics.timer('send'):
+                    sent = service.users().messages().send(userId=user_id, body=body, media_body=media).execute()
+            finally:
+                # the upload keeps the file open, which would stop it being removed on windows
+                if media:
+                    media.stream().close()
+                os.remove(path)
+    if measure:
+        if trace.peak is None:
+            print('Sent %d bytes of attachments by %s, peak memory not measured as other replies were '
+                  'sent at the same time.' % (size, method))
+        else:
+            print('Sent %d bytes of attachments by %s, peak memory %d bytes.' % (size, method, trace.peak))
+    return sent
+
+
+def GetAttachments(service, user_id, msg_id, dirname, message=None, borrow_http=None,
+    max_workers=ATTACHMENT_WORKERS):
     """Get and store attachment from Message with given id.
 
+    Attachments are decoded to disk a chunk at a time, and downloaded in
+    parallel if borrow_http is given.
+
     Args:
     service: Authorized Gmail API service instance.
     user_id: User's email address. The special value "me"
     can be used to indicate the authenticated user.
     msg_id: ID of Message containing attachment.
-    prefix: prefix which is added to the attachment filename on saving
+    dirname: directory in which the attachments are saved
+    message: the message if it has already been fetched
+    borrow_http: function returning a context manager which lends out an
+      authorized http object, one of which is used for each download since
+      http objects are not thread-safe
+    max_workers: maximum number of attachments downloaded at once
+
+    Returns:
+    List of the paths of the saved attachments.
     """
-    message = service.users().messages().get(userId=user_id, id=msg_id).execute()
+    if message is None:
+        message = service.users().messages().get(userId=user_id, id=msg_id).execute()
 
-    for part in message['payload']['parts']:
-        if part['filename']:
-            if 'data' in part['body']:
-                data=part['body']['data']
+    def download(part):
+        path = os.path.join(dirname, os.path.basename(part['filename']))
+        if 'data' in part['body']:
+            data = part['body']['data']
+        else:
+            att_id = part['body']['attachmentId']
+            request = service.users().messages().attachments().get(userId=user_id, messageId=msg_id, id=att_id)
+            if borrow_http:
+                with borrow_http() as http:
+                    data = request.execute(http=http)['data']
             else:
-                att_id=part['body']['attachmentId']
-                att=service.users().messages().attachments().get(userId=user_id, messageId=msg_id,id=att_id).execute()
-                data=att['data']
-            file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
-            path = os.path.join(dirname, part['filename'])
-
-            with open(path, 'wb') as f:
-                f.write(file_data)
-    
+                data = request.execute()['data']
+        size = WriteBase64File(data, path)
+        if 'size' in part['body'] and size != part['body']['size']:
+            os.remove(path)
+            raise log_utils.DataException('Attachment %s is %d bytes but should be %d bytes.' %
+                (part['filename'], size, part['body']['size']))
+        return path
+
+    parts = [part for part in message['payload']['parts'] if part['filename']]
+    if borrow_http and len(parts) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(download, parts))
+    return [download(part) for part in parts]
+
+
+def WriteBase64File(data, path, chunk_size=DECODE_CHUNK_SIZE):
+    """Decode base64url data to a file a chunk at a time, so that the decoded
+    copy never has to be held in memory all at once.
+
+    Returns:
+    Number of bytes written.
+    """
+    # chunks must be a multiple of 4 characters to decode separately
+    chunk_size -= chunk_size % 4
+    size = 0
+    with open(path, 'wb') as f:
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i+chunk_size]
+            chunk += '=' * (-len(chunk) % 4)
+            size += f.write(base64.urlsafe_b64decode(chunk.encode('UTF-8')))
+    return size
+
 def GetMessageBody(contents):
     # assumes plaintext message body
     for part in contents['payload']['parts']:
@@ -161,4 +376,88 @@ def GetMessageBody(contents):
             for sub_part in part['parts']:
                 if sub_part['mimeType'] == 'text/plain':
                     body = sub_part['body']['data']
-                    return base64.urlsafe_b64decode(body.encode('UTF-8')).decode('UTF-8')
\ No newline at end of file
+                    return base64.urlsafe_b64decode(body.encode('UTF-8')).decode('UTF-8')
+
+
+def BatchExecute(service, request_makers, batch_size=GMAIL_BATCH_SIZE, max_retries=GMAIL_BATCH_RETRIES):
+    """Execute several requests using as few batch HTTP requests as possible.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      request_makers: Dictionary mapping an id of the caller's choosing to a
+        function returning the (unexecuted) request.  A fresh request is made
+        each time an item is retried.
+      batch_size: Maximum number of requests per batch.
+      max_retries: Number of times items that failed with a rate limit or
+        server error are retried, with exponential backoff.
+
+    Returns:
+      Tuple of two dictionaries keyed by the caller's ids, the first holding
+      the responses of the requests that succeeded and the second the
+      exceptions of the ones that failed.
+    """
+    responses = {}
+    failures = {}
+    todo = list(request_makers)
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            responses[request_id] = response
+            failures.pop(request_id, None)
+        else:
+            failures[request_id] = exception
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        for i in range(0, len(todo), batch_size):
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id in todo[i:i+batch_size]:
+                batch.add(request_makers[request_id](), request_id=request_id)
+            batch.execute()
+        todo = [request_id for request_id, e in failures.items()
+                if isinstance(e, errors.HttpError) and e.resp.status in RETRY_STATUSES]
+        if not todo:
+            break
+
+    return (responses, failures)
+
+
+def BatchGetMessages(service, user_id, msg_ids, **kwargs):
+    """Get several messages using batch requests.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value "me"
+      can be used to indicate the authenticated user.
+      msg_ids: IDs of the messages to get.
+      kwargs: Extra arguments for messages().get, such as format.
+
+    Returns:
+      Tuple of dictionaries keyed by message id, holding the messages
+      and the exceptions of the ones which could not be fetched.
+    """
+    messages = service.users().messages()
+    return BatchExecute(service, dict(
+        (msg_id, lambda msg_id=msg_id: messages.get(userId=user_id, id=msg_id, **kwargs))
+        for msg_id in msg_ids))
+
+
+def BatchMarkAsRead(service, user_id, msg_ids):
+    """Remove the UNREAD label from several messages using batch requests.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value "me"
+      can be used to indicate the authenticated user.
+      msg_ids: IDs of the messages to mark.
+
+    Returns:
+      Dictionary mapping the ids of messages which could not be marked to the exception.
+    """
+    messages = service.users().messages()
+    _, failures = BatchExecute(service, dict(
+        (msg_id, lambda msg_id=msg_id: messages.modify(userId=user_id, id=msg_id,
+            body={'removeLabelIds': ['UNREAD'], 'addLabelIds': []}))
+        for msg_id in msg_ids))
+    return failures
@@ -0,0 +1,291 @@
+"""In-memory stand-in for the Gmail API service, so that the message
+handling can be exercised and benchmarked without a network connection.
+
+Run directly to compare fetching messages one at a time against batches.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import base64
+import copy
+import json
+import random
+import re
+import threading
+import time
+
+import httplib2
+from apiclient import errors
+
+
+class FakeRequest(object):
+    """Unexecuted request, like the ones returned by the real service."""
+    def __init__(self, service, func):
+        self.service = service
+        self.func = func
+
+    def execute(self, http=None, num_retries=0):
+        self.service.round_trip()
+        return self.service.call(self.func)
+
+
+class FakeBatch(object):
+    """Batch HTTP request, which costs a single round trip however many requests it holds."""
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        self.service.round_trip()
+        for request_id, request, callback in self.requests:
+            try:
+                response = self.service.call(request.func)
+            except errors.HttpError as e:
+                callback(request_id, None, e)
+            else:
+                callback(request_id, response, None)
+
+
+class FakeAttachments(object):
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, userId, messageId, id):
+        return FakeRequest(self.service, lambda: copy.deepcopy(self.service.attachment_data[id]))
+
+
+class FakeHistory(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, startHistoryId, historyTypes=None, pageToken=None):
+        def run():
+            if int(startHistoryId) < self.service.oldest_history_id:
+                raise http_error(404)
+            history = [{'id': str(history_id), 'messagesAdded': [{'message': message}]}
+                       for history_id, message in self.service.history_records
+                       if history_id > int(startHistoryId)]
+            result = {'historyId': str(self.service.history_id)}
+            if history:
+                result['history'] = copy.deepcopy(history)
+            return result
+        return FakeRequest(self.service, run)
+
+
+class FakeMessages(object):
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, maxResults=100, q='', pageToken=None):
+        def run():
+            found = [{'id': msg['id'], 'threadId': msg['threadId']}
+                     for msg in self.service.mailbox.values() if self.service.matches(msg, q)]
+            result = {'resultSizeEstimate': len(found[:maxResults])}
+            if found:
+                result['messages'] = found[:maxResults]
+            return result
+        return FakeRequest(self.service, run)
+
+    def get(self, userId, id, format='full', metadataHeaders=None, fields=None):
+        def run():
+            msg = copy.deepcopy(self.service.get_message(id))
+            if format == 'metadata':
+                headers = msg['payload']['headers']
+                if metadataHeaders:
+                    names = [name.lower() for name in metadataHeaders]
+                    headers = [header for header in headers if header['name'].lower() in names]
+                msg['payload'] = {'mimeType': msg['payload']['mimeType'], 'headers': headers}
+            return select_fields(msg, fields) if fields else msg
+        return FakeRequest(self.service, run)
+
+    def modify(self, userId, id, body):
+        def run():
+            msg = self.service.get_message(id)
+            msg['labelIds'] = [label for label in msg['labelIds'] if label not in body.get('removeLabelIds', [])]
+            msg['labelIds'] += [label for label in body.get('addLabelIds', []) if label not in msg['labelIds']]
+            self.service.history_id += 1
+            return copy.deepcopy(msg)
+        return FakeRequest(self.service, run)
+
+    def send(self, userId, body, media_body=None, **kwargs):
+        def run():
+            if media_body is not None:
+                # keep what would have been uploaded
+                stream = media_body.stream()
+                stream.seek(0)
+                body['media'] = stream.read()
+            self.service.sent.append(body)
+            return {'id': 'sent%d' % (len(self.service.sent),), 'labelIds': ['SENT']}
+        return FakeRequest(self.service, run)
+
+    def attachments(self):
+        return FakeAttachments(self.service)
+
+
+class FakeGmailService(object):
+    """Gmail service holding its mailbox in memory.
+
+    Args:
+      latency: Seconds added to every HTTP round trip.
+      failure_rate: Fraction of requests which fail with a 503 error.
+      seed: Seed for choosing which requests fail.
+    """
+    def __init__(self, latency=0, failure_rate=0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.mailbox = {}
+        self.attachment_data = {}
+        self.sent = []
+        self.history_id = 1
+        self.oldest_history_id = 1
+        self.history_records = []
+        self.num_round_trips = 0
+        self.num_requests = 0
+        self.num_bytes = 0
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return FakeMessages(self)
+
+    def history(self):
+        return FakeHistory(self)
+
+    def getProfile(self, userId):
+        return FakeRequest(self, lambda: {'emailAddress': 'me@fake.gmail', 'historyId': str(self.history_id),
+                                          'messagesTotal': len(self.mailbox)})
+
+    def expire_history(self):
+        """Make history ids older than the current one invalid, as happens after about a week."""
+        with self.lock:
+            self.oldest_history_id = self.history_id
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def round_trip(self):
+        with self.lock:
+            self.num_round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def call(self, func):
+        with self.lock:
+            self.num_requests += 1
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                raise http_error(503)
+            response = func()
+            # the size of the response as json, roughly what would come over the network
+            self.num_bytes += len(json.dumps(response))
+            return response
+
+    def get_message(self, msg_id):
+        if msg_id not in self.mailbox:
+            raise http_error(404)
+        return self.mailbox[msg_id]
+
+    def matches(self, msg, q):
+        # understands is:unread and subject:word, subject:"phrase" and subject:(words)
+        if 'is:unread' in q.split() and 'UNREAD' not in msg['labelIds']:
+            return False
+        subject = ' '.join(header['value'] for header in msg['payload']['headers']
+                           if header['name'] == 'Subject').lower()
+        for phrase, words, word in re.findall(r'subject:(?:"([^"]*)"|\(([^)]*)\)|(\S+))', q):
+            if phrase and phrase.lower() not in subject:
+                return False
+            if any(w.lower() not in subject.split() for w in (words or word).split()):
+                return False
+        return True
+
+    def add_message(self, subject, sender, body='', attachments=None, unread=True):
+        """Add a message to the mailbox.
+
+        Args:
+          subject: Subject of the message.
+          sender: From address of the message.
+          body: Plain text body of the message.
+          attachments: Dictionary mapping filenames to their contents as bytes.
+          unread: Whether the message starts out unread.
+
+        Returns:
+          The message id.
+        """
+        with self.lock:
+            msg_id = '%016x' % (len(self.mailbox) + 1,)
+            parts = [{'mimeType': 'text/plain', 'filename': '',
+                      'body': {'data': encode(body.encode('UTF-8')), 'size': len(body)}}]
+            for filename, data in (attachments or {}).items():
+                att_id = 'att%d' % (len(self.attachment_data) + 1,)
+                self.attachment_data[att_id] = {'data': encode(data), 'size': len(data)}
+                parts.append({'mimeType': 'application/octet-stream', 'filename': filename,
+                              'body': {'attachmentId': att_id, 'size': len(data)}})
+            self.mailbox[msg_id] = {
+                'id': msg_id,
+                'threadId': msg_id,
+                'labelIds': ['INBOX'] + (['UNREAD'] if unread else []),
+                'sizeEstimate': sum(len(encode(data)) for data in (attachments or {}).values()) + len(body),
+                'payload': {
+                    'mimeType': 'multipart/mixed',
+                    'headers': [
+                        {'name': 'Subject', 'value': subject},
+                        {'name': 'From', 'value': sender},
+                        {'name': 'Message-ID', 'value': '<%s@fake.gmail>' % (msg_id,)},
+                    ],
+                    'parts': parts,
+                },
+            }
+            self.history_id += 1
+            self.history_records.append((self.history_id, {'id': msg_id, 'threadId': msg_id,
+                                                           'labelIds': list(self.mailbox[msg_id]['labelIds'])}))
+            return msg_id
+
+
+def select_fields(obj, fields):
+    # applies a field mask such as 'id,labelIds,payload/headers'
+    selected = {}
+    for field in fields.split(','):
+        path = field.strip().split('/')
+        src, dst = obj, selected
+        for name in path[:-1]:
+            if name not in src:
+                break
+            src = src[name]
+            dst = dst.setdefault(name, {})
+        else:
+            if path[-1] in src:
+                dst[path[-1]] = src[path[-1]]
+    return selected
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode('UTF-8')
+
+
+def http_error(status):
+    return errors.HttpError(httplib2.Response({'status': status}), b'', uri='fake')
+
+
+if __name__ == '__main__':
+    import email_utils
+
+    service = FakeGmailService(latency=0.02)
+    msg_ids = [service.add_message('rtklib demo %d' % (i,), 'user@example.com') for i in range(200)]
+
+    start = time.time()
+    for msg_id in msg_ids:
+        service.users().messages().get(userId='me', id=msg_id).execute()
+    print('one at a time: %.2f s' % (time.time() - start,))
+
+    start = time.time()
+    email_utils.BatchGetMessages(service, 'me', msg_ids)
+    email_utils.BatchMarkAsRead(service, 'me', msg_ids)
+    print('batched get and mark as read: %.2f s' % (time.time() - start,))
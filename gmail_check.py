@@ -5,22 +5,39 @@
 # terms of the BSD-2-Clause license
 
 
-import httplib2
 import os
 
 import zipfile
 import base64
-from time import sleep
-import subprocess
-import re
-import statistics
+from time import sleep, strftime, gmtime
+import threading
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
 
-from apiclient import discovery
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
 import email_utils
+from stage_utils import Stage, run_stages
+from sync_utils import MailboxSync, PollInterval
+from service_utils import ServiceProvider
+from cache_utils import ResultCache, make_key, tool_id
+from config_utils import parse_line, get_template, check_overwrites, ConfigTemplate
+from reply_utils import package_reply
+from job_utils import JobStore, RUNNING, DONE, FAILED
+from metrics_utils import metrics
+from workspace_utils import Workspace
+from manifest_utils import Manifest
+from schedule_utils import Scheduler
+import proc_utils
+from proc_utils import run_tool
+from solve_utils import solve_sliced, slice_overwrites, compare_solutions, format_comparison
+from sweep_utils import split_sweep, sweep_variants, sweep_table
+import rinex_utils
+import plot_utils
+from rinex_utils import scan_obs_file, EpochIndex
 from log_utils import log_error, DataException
 
 try:
@@ -30,7 +47,16 @@ except ImportError:
     flags = None
 
 from my_constants import (SCOPES, CLIENT_SECRET_FILE, APPLICATION_NAME, MY_EMAIL,
-    PROCESS_SUBJECT, ORIG_BIN_DIR, DEMO5_BIN_DIR, DEBUGGING, ORIG_CONFIG_FILE,DEMO5_CONFIG_FILE)
+    PROCESS_SUBJECT, ORIG_BIN_DIR, DEMO5_BIN_DIR, DEBUGGING, ORIG_CONFIG_FILE,DEMO5_CONFIG_FILE,
+    MAX_WORKERS, MAX_STAGE_WORKERS, USE_RESULT_CACHE, NATIVE_PLOTS, SLICE_MIN_DURATION, SLICE_SECONDS,
+    SLICE_OVERLAP, SLICE_VALIDATE, SWEEP_WORKERS, ASYNC_ENGINE, ASYNC_QUEUE_SIZE, TRIAGE_HEADERS, TRIAGE_FIELDS,
+    QUICKLOOK_OPTION)
+
+# cache of tool outputs shared by all workers
+result_cache = ResultCache()
+# opened by open_job_store, so that importing this module creates no files
+job_store = None
+workspace = Workspace()
 
 def get_credentials():
     """Gets valid user credentials from storage.
@@ -55,6 +81,12 @@ def get_credentials():
         print('Storing credentials to ' + credential_path)
     return credentials
 
+# one set of credentials and discovery document, shared by all workers
+service_provider = ServiceProvider(get_credentials)
+
+def build_service():
+    return service_provider.service()
+
 def unzip_all_in_dir(dirname):
     for filename in os.listdir(dirname):
         filename = os.path.join(dirname, filename)
@@ -68,107 +100,87 @@ def unzip_all_in_dir(dirname):
             zip_arch.extractall(dirname)
             zip_arch.close()
 
-def file_is_rover(file):
-    # call the file the rover if it contains 'rov' or the base if it contains 'base'
-    # otherwise, look for an 'r' or 'b' in the filename and classify accordingly
-    file,_ = os.path.splitext(os.path.basename(file))
-    if file.find('rov') != -1:
-        return True
-    elif file.find('base') != -1:
-        return False
-    elif file.find('r') != -1:
-        return True
-    elif file.find('b') != -1:
-        return False
-    else:
-        raise DataException('Cannot determine whether to classify %s as a rover or base.' % (file,))
-
-def get_binary_files(dirname):
-    binary_exts = ['.ubx']
-    rover_bin = None
-    base_bin = None
-    for filename in os.listdir(dirname):
-        filename = os.path.join(dirname, filename)
-        file,ext = os.path.splitext(filename.lower())
-        if ext in binary_exts:
-            is_rover = file_is_rover(file)
-            if is_rover:
-                rover_bin = filename
-            else:
-                base_bin = filename
-    return (rover_bin, base_bin)
+def use_native_plots():
+    return NATIVE_PLOTS and plot_utils.available
 
-def get_obs_file(dirname, is_rover):
-    # first get observation files
-    obs_exts = ['.obs']
-    obs_re = '^\.\d+o$'
+def plot_tool():
+    # directory and file name of whatever draws the plots, for cache keys
+    if use_native_plots():
+        return (os.path.dirname(os.path.abspath(plot_utils.__file__)), 'plot_utils.py')
+    return (DEMO5_BIN_DIR, 'rtkplot.exe')
 
-    for filename in os.listdir(dirname):
-        filename = os.path.join(dirname, filename)
-        file,ext = os.path.splitext(filename.lower())
-        if ext in obs_exts or re.match(obs_re, ext):
-            if file_is_rover(filename) == is_rover:
-                return filename
-
-def get_nav_files(dirname, rover_obs):
-    # take files with the same name as rover obs if they exist,
-    # otherwise take whatever nav files can be found
-    base_rover_name = os.path.splitext(os.path.basename(os.path.normpath(rover_obs)))[0]
-    nav_re_strict = re.compile('^%s\..*nav$' % (base_rover_name,))
-    # nav_re_lenient = re.compile('^.*\..*nav$')
-    nav_files = list(filter(nav_re_strict.match, os.listdir(dirname)))
-    if len(nav_files) == 0:
-        # nav_files = list(filter(nav_re_lenient.match, os.listdir(dirname)))
-        nav_exts=['.nav','.17g']
-        nav_re = '^\.\d+n$'
-        for filename in os.listdir(dirname):
-            filename = os.path.join(dirname, filename)
-            file,ext = os.path.splitext(filename.lower())
-            if ext in nav_exts or re.match(nav_re, ext):
-                nav_files.append(filename)
+def save_plot(data_file, plot_file):
+    # plot in-process when numpy and matplotlib are available, which is much
+    # faster than starting rtkplot.exe and also works without a display
+    if use_native_plots():
+        plot_utils.save_image(data_file, plot_file)
     else:
-        for i in range(len(nav_files)):
-            nav_files[i] = os.path.join(dirname, nav_files[i])
-    
-    return nav_files
-
-
-def third_col_present(file):
-    # determine if third col of obs file has a number
-    with open(file) as obs_file:
-        # skip first 100 lines to avoid header
-        for line in obs_file.readlines()[100:]:
-            if line[0] == '>' or len(line.strip()) < 19:
-                continue
-            if line[18] == ' ':
-                return False
-            else:
-                return True
+        rtkplot_save_image(data_file, plot_file)
 
-def parse_line(line):
-    pos_eq = line.find('=')
-    pos_hash = line.find('#')
+def get_overwrites(rover_summary, base_summary, body):
+    # use obs file summaries to modfiy config file
+    overwrites = {}
+    # first use median delta to modify aroutcnt and arminfix
+    if rover_summary.sample_interval:
+        overwrites['pos2-aroutcnt'] = round(20/rover_summary.sample_interval)
+        overwrites['pos2-arminfix'] = round(20/rover_summary.sample_interval)
+    # then use presence or absence of 3rd column (=M8T) to choose cont. or f.-a.-h. AR
+    if rover_summary.third_col and base_summary.third_col:
+        overwrites['pos2-armode'] = 'continuous'
+        overwrites['pos2-gloarmode'] = 'on'
 
-    if pos_eq == -1:
-        return None
-    if pos_hash == -1:
-        pos_hash = len(line)
-    if pos_eq > pos_hash:
-        return None
+    # parse email body to modify config file
+    for line in body.splitlines():
+        nv_tuple = parse_line(line)
+        if nv_tuple:
+            overwrites[nv_tuple[0]] = nv_tuple[1]
+    # not a config option, see get_quicklook_interval
+    overwrites.pop(QUICKLOOK_OPTION, None)
 
-    name = line[:pos_eq].strip()
-    value = line[pos_eq+1:pos_hash].strip()
+    return overwrites
 
-    return (name, value)
+def get_quicklook_interval(body, sample_interval=None):
+    # seconds between the epochs kept for a quick-look solution, or None to keep them all;
+    # it must be at least a millisecond and, once sample_interval is known, longer than it
+    for line in body.splitlines():
+        nv_tuple = parse_line(line)
+        if nv_tuple and nv_tuple[0] == QUICKLOOK_OPTION:
+            try:
+                interval = float(nv_tuple[1])
+            except ValueError:
+                interval = 0
+            if not interval >= 0.001:
+                raise DataException('Invalid value "%s" for %s, expected the seconds between epochs.' %
+                    (nv_tuple[1], QUICKLOOK_OPTION))
+            if sample_interval and interval <= sample_interval:
+                raise DataException('The %s interval of %g s must be longer than the %g s between the rover '
+                    'observations.' % (QUICKLOOK_OPTION, interval, sample_interval))
+            return interval
+    return None
 
 def run_convbin(exe_dir, target_dir, binfile):
-    rc = subprocess.call([os.path.join(exe_dir, 'convbin.exe'), '-od', '-os', '-oi', '-ot', '-ro', '-TRK_MEAS=2', '-v', '3.03', '-d', target_dir, binfile])
+    metrics.observe('input_bytes', os.path.getsize(binfile), file='binary')
+    name = os.path.splitext(os.path.basename(binfile))[0]
+    rc = run_tool([os.path.join(exe_dir, 'convbin.exe'), '-r', 'ubx', '-od', '-os', '-oi', '-ot', '-ro', '-TRK_MEAS=2', '-v', '3.03',
+        '-d', target_dir, binfile], target_dir, 'convbin_' + name).returncode
     if rc != 0:
         raise DataException('Error encountered while running convbin.exe.')
 
-def run_rnx2rtkp(exe_dir, config, sln_file, rover_obs, base_obs, nav_files):
-    rc = subprocess.call([os.path.join(exe_dir, 'rnx2rtkp.exe'), '-k', config, '-o', 
-        sln_file, rover_obs, base_obs, ' '.join(nav_files)])
+def rnx2rtkp_time(seconds):
+    # rnx2rtkp takes times as two arguments, "y/m/d" and "h:m:s"
+    t = gmtime(int(seconds))
+    return [strftime('%Y/%m/%d', t), '%02d:%02d:%06.3f' % (t.tm_hour, t.tm_min, t.tm_sec + seconds % 1)]
+
+def run_rnx2rtkp(exe_dir, config, sln_file, rover_obs, base_obs, nav_files, start=None, end=None):
+    # solve from start to end if given, otherwise the whole of the observations
+    times = []
+    if start is not None:
+        times += ['-ts'] + rnx2rtkp_time(start)
+    if end is not None:
+        times += ['-te'] + rnx2rtkp_time(end)
+    rc = run_tool([os.path.join(exe_dir, 'rnx2rtkp.exe'), '-k', config, '-o', sln_file] + times +
+        [rover_obs, base_obs, ' '.join(nav_files)],
+        os.path.dirname(sln_file), 'rnx2rtkp_' + os.path.basename(sln_file)).returncode
     if rc != 0:
         raise DataException('Error encountered while running rnx2rtkp.exe.')
 
@@ -177,142 +189,286 @@ def rtkplot_save_image(sln_file, plot_file):
     exe_file = os.path.join(DEMO5_BIN_DIR, 'rtkplot.exe')
     sln_file = os.path.abspath(sln_file)
     plot_file = os.path.abspath(plot_file)
-    rc = subprocess.call([exe_file, '-s', plot_file, sln_file])
+    rc = run_tool([exe_file, '-s', plot_file, sln_file],
+        os.path.dirname(plot_file), 'rtkplot_' + os.path.basename(plot_file)).returncode
     if rc != 0:
         raise DataException('Error encountered while running rtkplot.exe.')
 
-def process_message(service, msg_id, body, sender, thread_id, subject, general_msg_id):
-    # create directory in which to work (message id should be unique)
-    dirname = os.path.join('runs', msg_id)
+def single_sln(sln_file):
+    # solution from a single pass, to validate a sliced solution against
+    name, ext = os.path.splitext(sln_file)
+    return name + '_single' + ext
 
-    try:
-        os.makedirs(dirname)
-    except os.error as error:
-        # exception will be raised if directory already exists
-        # this may be the case if we are debugging, in which
-        # case the exception may be ignored
-        if 0: #not DEBUGGING:
-            raise
+def run_cached(exe_dir, exe_name, input_files, target_dir, func, select, extra=()):
+    # run a tool unless its outputs for the same inputs (and extra settings) are in the cache
+    if not USE_RESULT_CACHE:
+        func()
+    else:
+        key = make_key(input_files, [tool_id(exe_dir, exe_name)] + list(extra))
+        if result_cache.run(key, target_dir, func, select):
+            print('Using cached output of %s for %s.' % (exe_name, input_files[0]))
+
+def describe_obs(rover_obs, base_obs):
+    # html summary of the timing of the observations, empty if numpy is not available
+    if not rinex_utils.np:
+        return ''
+    lines = []
+    with EpochIndex(rover_obs) as rover, EpochIndex(base_obs) as base:
+        for name, index in (('Rover', rover), ('Base', base)):
+            stats = index.interval_stats()
+            if not stats:
+                lines.append('%s: no observation epochs found.' % (name,))
+                continue
+            text = '%s: %d epochs over %.0f s, sample interval %g s, %d gap(s)' % (name, len(index.times),
+                index.times[-1] - index.times[0], stats['median'], len(index.gaps()))
+            for time, old, new in index.rate_changes():
+                text += ', rate changes from %g s to %g s at %s' % (old, new, strftime('%H:%M:%S', gmtime(time)))
+            lines.append(text + '.')
+        overlap = rover.overlap(base)
+        if overlap:
+            lines.append('Rover and base observations overlap for %.0f s, with %d epochs in common.' %
+                (overlap[1] - overlap[0], overlap[2]))
+        else:
+            lines.append('<b>Warning: rover and base observations do not overlap in time.</b>')
+    return '<div align="left">%s</div>' % ('<br>\n'.join(lines),)
+
+def process_message(service, msg_id, body, sender, thread_id, subject, general_msg_id, contents=None):
+    # directory in which to work (message id should be unique), which
+    # may be on a tmpfs until the job is finished
+    dirname = workspace.job_dir(msg_id)
+
+    # stages completed before a crash or restart are not run again
+    done = job_store.checkpoints(msg_id, dirname)
+    if 'replied' in done:
+        return
 
     # fetch attachments
-    email_utils.GetAttachments(service, 'me', msg_id, dirname)
+    if 'fetched' not in done:
+        with metrics.timer('download attachments'):
+            paths = email_utils.GetAttachments(service, 'me', msg_id, dirname, contents,
+                borrow_http=service_provider.borrow_http)
+        for path in paths:
+            metrics.observe('input_bytes', os.path.getsize(path), file='attachment')
+        job_store.checkpoint(msg_id, 'fetched', {'paths': paths}, ['paths'], dirname)
 
     # detect if file is zipped, and if so, unzip it
-    unzip_all_in_dir(dirname)
+    if 'unzipped' not in done:
+        with metrics.timer('unzip'):
+            unzip_all_in_dir(dirname)
+        job_store.checkpoint(msg_id, 'unzipped')
+
+    # the files of each directory of the job, told apart by their headers
+    manifest = Manifest()
 
     # first check if there are rover and base binary files
-    rover_bin, base_bin = get_binary_files(dirname)
+    rover_bin, base_bin = manifest.binary_files(dirname)
 
-    # convert binary files to text files if necessary
+    # convert binary files to text files if necessary, then solve and plot
+    # the orig and demo5 toolchains do not depend on each other, so the
+    # stages below are run in parallel whenever their inputs are ready
     orig_dir = os.path.join(dirname, 'orig')
     demo5_dir = os.path.join(dirname, 'demo5')
-    if rover_bin:
-        run_convbin(ORIG_BIN_DIR, orig_dir, rover_bin)
-        run_convbin(DEMO5_BIN_DIR, demo5_dir, rover_bin)
-    if base_bin:
-        run_convbin(ORIG_BIN_DIR, orig_dir, base_bin)
-        run_convbin(DEMO5_BIN_DIR, demo5_dir, base_bin)
-
-    # next get rover and base text files
-    # the directories in which we look for them depend on whether we created them ourselves
-    if rover_bin:
-        orig_rover_obs = get_obs_file(orig_dir, True)
-        demo5_rover_obs = get_obs_file(demo5_dir, True)
-    else:
-        orig_rover_obs = demo5_rover_obs = get_obs_file(dirname, True)
-    if not orig_rover_obs or not demo5_rover_obs:
-        raise DataException('Could not detect rover observation file (even after running convbin if necessary).')
-        
-    if base_bin:
-        orig_base_obs = get_obs_file(orig_dir, False)
-        demo5_base_obs = get_obs_file(demo5_dir, False)
-    else:
-        orig_base_obs = demo5_base_obs = get_obs_file(dirname, False)
-    if not orig_base_obs or not demo5_base_obs:
-        raise DataException('Could not detect base observation file in directory %s (even after running convbin if necessary).')
-    
-    # next find navigation files
-    # again, directories in which to look are dependent on previously run commands
-    if rover_bin:
-        orig_nav_files = get_nav_files(orig_dir, orig_rover_obs)
-        demo5_nav_files = get_nav_files(demo5_dir, demo5_rover_obs)
-    else:
-        orig_nav_files = demo5_nav_files = get_nav_files(dirname, orig_rover_obs)
-    if len(orig_nav_files) == 0 or len(demo5_nav_files) == 0:
-        raise DataException('Could not find any navigation files (even after running convbin if necessary).')
-
-    # parse obs files to modfiy config file
-    overwrites = {}
-    #if rover_bin and base_bin:
-    with open(demo5_rover_obs) as obs_file:
-        # first compute median delta to modify aroutcnt and arminfix
-        times = []
-        num_skipped = 0
-        num_to_skip = 50
-        num_read = 0
-        num_to_read = 11
-        for line in obs_file:
-            if line[0] == '>':
-                if num_skipped < num_to_skip:
-                    num_skipped += 1
-                else:
-                    # time always starts and ends at same spot
-                    times.append(float(line[19:29]))
-                    num_read += 1
-                    if num_read == num_to_read:
-                        break
-        if len(times):
-            deltas = [times[i] - times[i-1] for i in range(1, len(times))]
-            median_delta = statistics.median(deltas)
-            overwrites['pos2-aroutcnt'] = round(20/median_delta)
-            overwrites['pos2-arminfix'] = round(20/median_delta) 
-    # then use presence or absence of 3rd column (=M8T) to choose cont. or f.-a.-h. AR
-    present_in_rover = third_col_present(demo5_rover_obs)
-    present_in_base = third_col_present(demo5_base_obs)
-    if present_in_rover and present_in_base:
-        overwrites['pos2-armode'] = 'continuous'
-        overwrites['pos2-gloarmode'] = 'on'
-
-    # parse email body to modify config file
-    for line in body.splitlines():
-        nv_tuple = parse_line(line)
-        if nv_tuple:
-            overwrites[nv_tuple[0]] = nv_tuple[1]
-
+    sweep_dir = os.path.join(dirname, 'sweep')
     orig_config = os.path.join(dirname, ORIG_CONFIG_FILE)
-    with open(ORIG_CONFIG_FILE, 'r') as config_template, open(orig_config, 'w') as my_config:
-        for line in config_template:
-            nv_tuple = parse_line(line)
-            if nv_tuple and nv_tuple[0] in overwrites:
-                line = '%s=%s\n' % (nv_tuple[0], overwrites[nv_tuple[0]])
-            my_config.write(line) 
-                
     demo5_config = os.path.join(dirname, DEMO5_CONFIG_FILE)
-    with open(DEMO5_CONFIG_FILE, 'r') as config_template, open(demo5_config, 'w') as my_config:
-        for line in config_template:
-            nv_tuple = parse_line(line)
-            if nv_tuple and nv_tuple[0] in overwrites:
-                line = '%s=%s\n' % (nv_tuple[0], overwrites[nv_tuple[0]])
-            my_config.write(line) 
-
-
-    # do processing on these files
     orig_sln = os.path.join(orig_dir, 'out_orig.pos')
     demo5_sln = os.path.join(demo5_dir, 'out_demo5.pos')
-    run_rnx2rtkp(ORIG_BIN_DIR, orig_config, orig_sln, orig_rover_obs, orig_base_obs, orig_nav_files)
-    run_rnx2rtkp(DEMO5_BIN_DIR, demo5_config, demo5_sln, demo5_rover_obs, demo5_base_obs, demo5_nav_files)
-
-    # graph these files
     orig_plot = os.path.join(orig_dir, 'plot_orig.jpg')
     demo5_plot = os.path.join(demo5_dir, 'plot_demo5.jpg')
-    rtkplot_save_image(orig_sln, orig_plot)
-    rtkplot_save_image(demo5_sln, demo5_plot)
-
-    # also graph the obs files located in the extended directory
     obs_rover_plot = os.path.join(dirname, 'plot_obs_rover.jpg')
     obs_base_plot = os.path.join(dirname, 'plot_obs_base.jpg')
-    rtkplot_save_image(demo5_rover_obs, obs_rover_plot)
-    rtkplot_save_image(demo5_base_obs, obs_base_plot)
+    sweep_report = os.path.join(dirname, 'sweep_report.html')
+
+    # create the output directories up front so that parallel convbin runs do not race to do so
+    for target_dir in (orig_dir, demo5_dir):
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+
+    # the outputs of each tool are cached by a hash of its inputs, so that resubmitting
+    # the same data with a different config only reruns rnx2rtkp and the solution plots
+    def convert(exe_dir, target_dir, binfile):
+        # returns the directory holding the observations for this receiver
+        # which depends on whether we created them ourselves
+        if not binfile:
+            return dirname
+        name = os.path.splitext(os.path.basename(binfile))[0]
+        run_cached(exe_dir, 'convbin.exe', [binfile], target_dir,
+            lambda: run_convbin(exe_dir, target_dir, binfile),
+            lambda filename: os.path.splitext(filename)[0] == name)
+        return target_dir
+
+    quicklook_interval = get_quicklook_interval(body)
+
+    def check_quicklook(rover_obs):
+        # once, for both toolchains, now that the rate of the rover is known
+        if not quicklook_interval:
+            return None
+        return get_quicklook_interval(body, scan_obs_file(rover_obs).sample_interval)
+
+    def decimate(target_dir):
+        # thin the observations for a quick-look solution; the rate-dependent config
+        # overwrites follow, since the summaries are taken from the thinned files
+        def run(interval, rover_obs, base_obs):
+            if not interval:
+                return (rover_obs, base_obs)
+            quicklook_dir = os.path.join(target_dir, 'quicklook')
+            if not os.path.isdir(quicklook_dir):
+                os.makedirs(quicklook_dir)
+            keeps = rinex_utils.quicklook_epochs(rover_obs, base_obs, interval)
+            thinned = []
+            for obs_file, keep in zip((rover_obs, base_obs), keeps):
+                thinned.append(os.path.join(quicklook_dir, os.path.basename(obs_file)))
+                num_read, num_kept = rinex_utils.decimate_obs_file(obs_file, thinned[-1], interval, keep)
+                print('Kept %d of %d epochs of %s.' % (num_kept, num_read, obs_file))
+                if num_kept == 0:
+                    raise DataException('No observation epochs were found in %s to thin for the quick-look '
+                        'solution.' % (os.path.basename(obs_file),))
+            return tuple(thinned)
+        return run
+
+    def write_configs(rover_summary, base_summary):
+        # check the overwrites before any time is spent running rnx2rtkp
+        # options given several values are solved with the first of them here,
+        # and with every combination of them by the sweep stage
+        overwrites, swept = split_sweep(get_overwrites(rover_summary, base_summary, body))
+        variants = sweep_variants(swept)
+        orig_template = get_template(ORIG_CONFIG_FILE)
+        demo5_template = get_template(DEMO5_CONFIG_FILE)
+        unknown_keys = check_overwrites(overwrites, [orig_template, demo5_template])
+        for variant in variants[1:]:
+            check_overwrites(variant, [demo5_template])
+        orig_template.write(orig_config, overwrites)
+        demo5_template.write(demo5_config, overwrites)
+        return (orig_config, demo5_config, unknown_keys, variants)
+
+    def sweep(rover_summary, base_summary, variants, rover_obs, base_obs, nav_files):
+        # the first variant is the demo5 solution itself
+        overwrites = split_sweep(get_overwrites(rover_summary, base_summary, body))[0]
+        demo5_template = get_template(DEMO5_CONFIG_FILE)
+        def run(i):
+            variant_dir = os.path.join(sweep_dir, 'variant_%02d' % (i,))
+            if not os.path.isdir(variant_dir):
+                os.makedirs(variant_dir)
+            config = os.path.join(variant_dir, DEMO5_CONFIG_FILE)
+            demo5_template.write(config, dict(overwrites, **variants[i]))
+            sln_file = os.path.join(variant_dir, 'out_demo5_%02d.pos' % (i,))
+            return solve(DEMO5_BIN_DIR, sln_file)(config, rover_obs, base_obs, nav_files, rover_summary)
+        with ThreadPoolExecutor(max_workers=SWEEP_WORKERS) as pool:
+            return list(pool.map(run, range(1, len(variants))))
+
+    def compare_sweep(variants, demo5_sln, sweep_slns):
+        # the html is written to a file, so that the checkpoint holds only its path
+        report = ''
+        if variants:
+            report = ('<p align="left"><b>Comparison of settings</b>: the demo5 solution was computed with each '
+                      'combination of the settings given several values in your email.</p>%s' %
+                      (sweep_table(variants, [demo5_sln] + sweep_slns),))
+        with open(sweep_report, 'w') as f:
+            f.write(report)
+        return sweep_report
+
+    def solve(exe_dir, sln_file):
+        # long observation files are solved in overlapping time slices in parallel, and
+        # optionally in a single pass as well, to check the merged solution against
+        def run(config, rover_obs, base_obs, nav_files, rover_summary):
+            name = os.path.splitext(os.path.basename(sln_file))[0]
+            sliced = (SLICE_MIN_DURATION and rover_summary.num_epochs > 1 and
+                      rover_summary.end_time - rover_summary.start_time > SLICE_MIN_DURATION)
+            def solve_all():
+                if not sliced:
+                    run_rnx2rtkp(exe_dir, config, sln_file, rover_obs, base_obs, nav_files)
+                    return
+                # the slices, and the single pass they are checked against, are
+                # solved with their output set to what the merge can read
+                template = ConfigTemplate(config)
+                slice_config = os.path.join(os.path.dirname(sln_file), name + '_slices.conf')
+                template.write(slice_config, slice_overwrites(template))
+                def solve_once(pos_file, start=None, end=None):
+                    run_rnx2rtkp(exe_dir, slice_config, pos_file, rover_obs, base_obs, nav_files, start, end)
+                solve_sliced(solve_once, rover_summary.start_time, rover_summary.end_time, sln_file)
+                if SLICE_VALIDATE:
+                    solve_once(single_sln(sln_file))
+            run_cached(exe_dir, 'rnx2rtkp.exe', [config, rover_obs, base_obs] + nav_files,
+                os.path.dirname(sln_file), solve_all,
+                lambda filename: filename.startswith(name),
+                [SLICE_SECONDS, SLICE_OVERLAP, SLICE_VALIDATE] if sliced else [])
+            return sln_file
+        return run
+
+    def plot(plot_file):
+        def run(sln_file):
+            name = os.path.basename(plot_file)
+            tool_dir, tool_name = plot_tool()
+            run_cached(tool_dir, tool_name, [sln_file], os.path.dirname(plot_file),
+                lambda: save_plot(sln_file, plot_file),
+                lambda filename: filename == name)
+            return plot_file
+        return run
+
+    # the values recorded with each checkpoint of the stages below, and which of them are paths
+    converted_paths = ['orig_rover_dir', 'orig_base_dir', 'demo5_rover_dir', 'demo5_base_dir',
+        'orig_rover_obs', 'orig_base_obs', 'orig_nav_files', 'demo5_rover_obs', 'demo5_base_obs', 'demo5_nav_files',
+        'orig_solve_rover', 'orig_solve_base', 'demo5_solve_rover', 'demo5_solve_base']
+    solved_paths = ['orig_config', 'demo5_config', 'orig_sln', 'demo5_sln', 'sweep_slns', 'sweep_report']
+    plotted_paths = ['orig_plot', 'demo5_plot', 'obs_rover_plot', 'obs_base_plot']
+    checkpoint_values = [
+        ('converted', converted_paths + ['quicklook_interval'], converted_paths),
+        ('solved', solved_paths + ['unknown_keys', 'sweep_variants'], solved_paths),
+        ('plotted', plotted_paths, plotted_paths),
+    ]
+    restored = {}
+    for stage, _, _ in checkpoint_values:
+        restored.update(done.get(stage, {}))
+
+    def record_checkpoints(values):
+        for stage, names, path_names in checkpoint_values:
+            if stage in done:
+                continue
+            if not all(name in values for name in names):
+                break
+            done[stage] = dict((name, values[name]) for name in names)
+            job_store.checkpoint(msg_id, stage, done[stage], path_names, dirname)
+
+    stages = [
+        Stage('convbin orig rover', lambda: convert(ORIG_BIN_DIR, orig_dir, rover_bin), outputs=['orig_rover_dir']),
+        Stage('convbin orig base', lambda: convert(ORIG_BIN_DIR, orig_dir, base_bin), outputs=['orig_base_dir']),
+        Stage('convbin demo5 rover', lambda: convert(DEMO5_BIN_DIR, demo5_dir, rover_bin), outputs=['demo5_rover_dir']),
+        Stage('convbin demo5 base', lambda: convert(DEMO5_BIN_DIR, demo5_dir, base_bin), outputs=['demo5_base_dir']),
+        Stage('find orig inputs', manifest.input_files, inputs=['orig_rover_dir', 'orig_base_dir'],
+            outputs=['orig_rover_obs', 'orig_base_obs', 'orig_nav_files']),
+        Stage('find demo5 inputs', manifest.input_files, inputs=['demo5_rover_dir', 'demo5_base_dir'],
+            outputs=['demo5_rover_obs', 'demo5_base_obs', 'demo5_nav_files']),
+        Stage('check quick-look', check_quicklook, inputs=['demo5_rover_obs'], outputs=['quicklook_interval']),
+        Stage('decimate orig', decimate(orig_dir), inputs=['quicklook_interval', 'orig_rover_obs', 'orig_base_obs'],
+            outputs=['orig_solve_rover', 'orig_solve_base']),
+        Stage('decimate demo5', decimate(demo5_dir), inputs=['quicklook_interval', 'demo5_rover_obs', 'demo5_base_obs'],
+            outputs=['demo5_solve_rover', 'demo5_solve_base']),
+        Stage('scan rover obs', scan_obs_file, inputs=['demo5_solve_rover'], outputs=['rover_summary']),
+        Stage('scan base obs', scan_obs_file, inputs=['demo5_solve_base'], outputs=['base_summary']),
+        Stage('index obs', describe_obs, inputs=['demo5_rover_obs', 'demo5_base_obs'], outputs=['obs_report']),
+        Stage('write configs', write_configs, inputs=['rover_summary', 'base_summary'],
+            outputs=['orig_config', 'demo5_config', 'unknown_keys', 'sweep_variants']),
+        Stage('rnx2rtkp orig', solve(ORIG_BIN_DIR, orig_sln),
+            inputs=['orig_config', 'orig_solve_rover', 'orig_solve_base', 'orig_nav_files', 'rover_summary'],
+            outputs=['orig_sln']),
+        Stage('rnx2rtkp demo5', solve(DEMO5_BIN_DIR, demo5_sln),
+            inputs=['demo5_config', 'demo5_solve_rover', 'demo5_solve_base', 'demo5_nav_files', 'rover_summary'],
+            outputs=['demo5_sln']),
+        Stage('rnx2rtkp sweep', sweep, inputs=['rover_summary', 'base_summary', 'sweep_variants',
+            'demo5_solve_rover', 'demo5_solve_base', 'demo5_nav_files'], outputs=['sweep_slns']),
+        Stage('compare sweep', compare_sweep, inputs=['sweep_variants', 'demo5_sln', 'sweep_slns'],
+            outputs=['sweep_report']),
+        Stage('plot orig', plot(orig_plot), inputs=['orig_sln'], outputs=['orig_plot']),
+        Stage('plot demo5', plot(demo5_plot), inputs=['demo5_sln'], outputs=['demo5_plot']),
+        # also graph the obs files located in the extended directory
+        Stage('plot rover obs', plot(obs_rover_plot), inputs=['demo5_rover_obs'], outputs=['obs_rover_plot']),
+        Stage('plot base obs', plot(obs_base_plot), inputs=['demo5_base_obs'], outputs=['obs_base_plot']),
+    ]
+    for stage in stages:
+        stage.func = metrics.timed(stage.name, stage.func)
+    values = run_stages(stages, MAX_STAGE_WORKERS, restored, record_checkpoints)
+    for key in ('rover_summary', 'base_summary'):
+        metrics.observe('obs_epochs', values[key].num_epochs, file=key.split('_')[0])
 
     # send reply message
     
@@ -328,6 +484,7 @@ def process_message(service, msg_id, body, sender, thread_id, subject, general_m
           <div style="margin-bottom:50px">
             <p align="left"><b>RTKLIB Demonstration Results</b>:<br>
             </p>
+            <!-- config notes -->
             <div align="left">Before looking at the solution, it's always a good
               idea to take a quick look at the base and rover observations.&nbsp; More often than not, 
               the reason for a poor solution can be fairly obvious in the observation plots.&nbsp; Things to
@@ -362,6 +519,9 @@ def process_message(service, msg_id, body, sender, thread_id, subject, general_m
                 </tr>
               </tbody>
             </table>
+            <!-- obs report -->
+            <!-- solve notes -->
+            <!-- sweep report -->
             <p align="center"> </p>
             <br>
             <br>
@@ -399,6 +559,8 @@ def process_message(service, msg_id, body, sender, thread_id, subject, general_m
               src="cid:plot_orig.jpg" alt="2.4.3 sol" width="80%"><br>
             <br>
             <div align="left"><br>
+              Attached files:<br>
+              <!-- attachment report -->
             </div>
           </div>
         </div>
@@ -407,6 +569,22 @@ def process_message(service, msg_id, body, sender, thread_id, subject, general_m
 
     
     
+    html = html.replace('<!-- obs report -->', values['obs_report'])
+    with open(values['sweep_report']) as f:
+        html = html.replace('<!-- sweep report -->', f.read())
+    notes = ['%s %s' % (label, format_comparison(compare_solutions(sln_file, single_sln(sln_file))))
+             for label, sln_file in (('demo5', demo5_sln), ('2.4.3', orig_sln)) if os.path.exists(single_sln(sln_file))]
+    if quicklook_interval:
+        html = html.replace('<!-- solve notes -->', '<p align="left"><b>Note</b>: these are quick-look solutions, '
+            'computed from the observations thinned to one epoch every %g s (%d rover epochs).</p><!-- solve notes -->' %
+            (quicklook_interval, values['rover_summary'].num_epochs))
+    if notes:
+        html = html.replace('<!-- solve notes -->', '<p align="left"><b>Note</b>: the solutions were computed in '
+            'overlapping time slices in parallel.  Compared with a single pass:<br>%s</p>' % ('<br>'.join(notes),))
+    if values['unknown_keys']:
+        html = html.replace('<!-- config notes -->', '<p align="left"><b>Note</b>: these settings in the body of your email '
+            'are not options in the config files and were ignored: %s</p>' % (', '.join(values['unknown_keys']),))
+
     attachments = [
         {'path': orig_plot, 'disposition': 'inline'},
         {'path': demo5_plot, 'disposition': 'inline'},
@@ -416,114 +594,414 @@ def process_message(service, msg_id, body, sender, thread_id, subject, general_m
         {'path': demo5_sln, 'disposition': 'attachment'},
         {'path': orig_config, 'disposition': 'attachment'},
         {'path': demo5_config, 'disposition': 'attachment'}
-    ]
+    ] + [{'path': sln_file, 'disposition': 'attachment'} for sln_file in values['sweep_slns']]
+    attachments, report = package_reply(attachments, os.path.join(dirname, 'reply'))
+    html = html.replace('<!-- attachment report -->', report)
     # because the reply will always be following an original message, "References" and "In-Reply-To" should be the same
-    print('Generate reply:')
-    credentials = get_credentials()
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('gmail', 'v1', http=http)
-    
-    message = email_utils.CreateMessageWithAttachments(MY_EMAIL, sender, "Re:"+subject, html, True,
-        attachments, thread_id, general_msg_id, general_msg_id)
     print('Send Reply:')
-    email_utils.SendMessage(service, 'me', message)
+    email_utils.SendMessageWithAttachments(service, 'me', MY_EMAIL, sender, "Re:"+subject, html, True,
+        attachments, thread_id, general_msg_id, general_msg_id)
+    job_store.checkpoint(msg_id, 'replied')
 
             
-def process_messages(service):
-    """Continuously loop, reading unread messages and processing
-    them if necessary.
-    """
-    while (True):
-        messages = service.users().messages().list(userId='me', maxResults=10000, q='is:unread').execute()
+def message_headers(contents):
+    # the headers needed from a message, in one pass over them
+    headers = {}
+    for header in contents['payload'].get('headers', []):
+        if header['name'] in TRIAGE_HEADERS and header['name'] not in headers:
+            headers[header['name']] = header['value']
+    return headers
 
-        if not messages or messages['resultSizeEstimate'] == 0:
-            print('No messages to process. Sleeping for 10 seconds.')
-            sleep(10)
-        else:
-            num_processed = 0
+def should_process(contents):
+    # only process emails with PROCESS_SUBJECT in the subject
+    return message_headers(contents).get('Subject', '').lower().find(PROCESS_SUBJECT) != -1
+
+def fetch_messages(service, msg_ids, hold=None):
+    """Fetch the unread messages which are to be processed.
+
+    The headers of every message are fetched first, and then only the
+    messages with PROCESS_SUBJECT in the subject are fetched in full.  The
+    others are marked as read, as they would be once processed.
 
-            print('%d unread messages...' % (len(messages['messages'],)))
-            for message in messages['messages']:
+    Args:
+      hold: Function given the messages to process, with their headers
+        only, returning the ids of those to leave unfetched for now.
+
+    Returns:
+      Tuple of dictionaries keyed by message id, holding the messages to
+      process and the exceptions of the ones which could not be fetched,
+      and the list of ids of the messages held back.
+    """
+    with metrics.timer('gmail triage'):
+        headers, failures = email_utils.BatchGetMessages(service, 'me', msg_ids, format='metadata',
+            metadataHeaders=TRIAGE_HEADERS, fields=TRIAGE_FIELDS)
+    # messages may show up twice when the history overlaps a full listing
+    unread = [msg_id for msg_id in msg_ids if msg_id in headers and
+              'UNREAD' in headers[msg_id].get('labelIds', ['UNREAD'])]
+    wanted = [msg_id for msg_id in unread if should_process(headers[msg_id])]
+    ignored = [msg_id for msg_id in unread if msg_id not in wanted]
+    if ignored:
+        print('Marking %d unread messages without "%s" in the subject as read.' % (len(ignored), PROCESS_SUBJECT))
+        if not DEBUGGING:
+            for msg_id, e in email_utils.BatchMarkAsRead(service, 'me', ignored).items():
+                # listed, and so tried again, by the next full sync
+                print('Failed to mark message %s as read. Error: %s.' % (msg_id, e))
+    held = hold([headers[msg_id] for msg_id in wanted]) if hold else []
+    wanted = [msg_id for msg_id in wanted if msg_id not in held]
+    contents = {}
+    if wanted:
+        with metrics.timer('gmail get'):
+            contents, more_failures = email_utils.BatchGetMessages(service, 'me', wanted)
+        failures.update(more_failures)
+    return (contents, failures, held)
+
+def handle_message(contents):
+    """Process and reply to a single fetched message.
+
+    Runs on a worker thread, so it uses the service belonging to that thread.
+    Messages whose jobs have already finished are not processed again.
+    """
+    status = job_store.status(contents['id'])
+    if status in (DONE, FAILED):
+        return status == DONE
+    job_store.set_status(contents['id'], RUNNING)
+    service = build_service()
+    headers = message_headers(contents)
+    sender = headers.get('From')
+    # record exact subject (considering caps) for reply
+    subject = headers.get('Subject', '')
+    general_msg_id = headers.get('Message-ID')
+    try:
+        # do actual processing if necessary
+        if should_process(contents):
+            # determine message body
+            body = email_utils.GetMessageBody(contents)
+            #if not body:
+            #    raise Exception('Error reading body of email.')
+
+            if sender and general_msg_id:
+                print('Processing message %s...' % (contents['id'],))
+                dirname = workspace.job_dir(contents['id'])
                 try:
-                    contents = service.users().messages().get(userId='me', id=message['id']).execute()
-
-                    # only process emails with subject="Process Request"
-                    should_process_message = False
-                    subject = ''
-                    for header in contents['payload']['headers']:
-                        if header['name'] == 'Subject':
-                            #print('subject= %s' % header['value'])
-                            if header['value'].lower().find(PROCESS_SUBJECT) != -1:
-                                should_process_message = True
-                                # record exact subject (considering caps) for reply
-                                subject = header['value']
-                                break
-
-                    # do actual processing if necessary
-                    if should_process_message:
-                        # determine message body
-                        body = email_utils.GetMessageBody(contents)
-                        #if not body:
-                        #    raise Exception('Error reading body of email.')
-
-                        # determine sender and universal id
-                        sender = None
-                        general_msg_id = None
-                        for header in contents['payload']['headers']:
-                            if header['name'] == 'From':
-                                sender = header['value']
-                            if header['name'] == 'Message-ID':
-                                general_msg_id = header['value']
-                        if sender and general_msg_id:
-                            print('Processing message %s...' % (message['id'],))
-                            process_message(service, message['id'], body, sender, message['threadId'], subject, general_msg_id)
-                        else:
-                            if not sender:
-                                raise DataException('Could not determine sender.')
-                            else:
-                                raise DataException('Could not determine message ID.')
-                        num_processed += 1
-                except Exception as e:
-                    reply_email_successful = True
-                    try:
-                        reply_text = 'RTKLIB was unable to process the data.  Please check that you followed all of the guidelines for submitting data.  At this point the process is still immature so it is quite possible the problem is on this end. '
-                        if e is DataException:
-                            reply_text += '\nNote: the specific error that triggered this response is "%s".' % (str(e),)
-                        reply_message = email_utils.CreateMessageWithAttachments(MY_EMAIL, sender, subject, reply_text, False,
-                            None, message['threadId'], general_msg_id, general_msg_id)
-                        email_utils.SendMessage(service, 'me', reply_message)
-                    except Exception as ee:
-                        print('Failed to send reply to user. Error: %s.' % (ee,))
-                        reply_email_successful = False
-                    
-                    text = 'Error while processing message %s:' % (message['id'],)
-                    if not reply_email_successful:
-                        text += '\nNote: reply email not successfully sent to data sender.'
-                    log_error(e, text, service)
+                    with metrics.job(contents['id'], dirname), metrics.timer('job'):
+                        process_message(service, contents['id'], body, sender, contents['threadId'], subject,
+                            general_msg_id, contents)
                 finally:
-                    # mark message as read
-                    if not DEBUGGING:
-                        service.users().messages().modify(userId='me', id=message['id'],
-                            body={'removeLabelIds': ['UNREAD'], 'addLabelIds': []}).execute()
+                    workspace.finish(contents['id'])
+            else:
+                if not sender:
+                    raise DataException('Could not determine sender.')
+                else:
+                    raise DataException('Could not determine message ID.')
+            job_store.set_status(contents['id'], DONE)
+            metrics.count('jobs_total', status=DONE)
+            return True
+        job_store.set_status(contents['id'], DONE)
+        return False
+    except Exception as e:
+        reply_email_successful = True
+        try:
+            reply_text = 'RTKLIB was unable to process the data.  Please check that you followed all of the guidelines for submitting data.  At this point the process is still immature so it is quite possible the problem is on this end. '
+            if isinstance(e, DataException):
+                reply_text += '\nNote: the specific error that triggered this response is "%s".' % (str(e),)
+            reply_message = email_utils.CreateMessageWithAttachments(MY_EMAIL, sender, subject, reply_text, False,
+                None, contents['threadId'], general_msg_id, general_msg_id)
+            email_utils.SendMessage(service, 'me', reply_message)
+        except Exception as ee:
+            print('Failed to send reply to user. Error: %s.' % (ee,))
+            reply_email_successful = False
+        
+        text = 'Error while processing message %s:' % (contents['id'],)
+        if not reply_email_successful:
+            text += '\nNote: reply email not successfully sent to data sender.'
+        log_error(e, text, service)
+        job_store.set_status(contents['id'], FAILED, str(e))
+        metrics.count('jobs_total', status=FAILED)
+        return False
 
+def open_job_store():
+    global job_store
+    if job_store is None:
+        job_store = JobStore()
+    return job_store
+
+def job_finished(msg_id):
+    # runs from before the job store have no status
+    return job_store.status(msg_id) in (DONE, FAILED, None)
+
+def process_messages(service, max_workers=None):
+    """Continuously loop, reading unread messages and handing them
+    to a pool of worker threads for processing.
+
+    Up to max_workers messages (default MAX_WORKERS, or one per cpu core)
+    are processed at once.  New messages are found with MailboxSync and
+    fetched with batch requests, and finished ones are marked as read in a
+    batch as well.  The time between polls adapts to the traffic.
+
+    Fetched messages wait in a Scheduler, which hands the next one to each
+    worker as it becomes free, shortest and least served senders first.
+    A message stays unread until its worker is done with it, so the ids of
+    messages still in flight are remembered to avoid queuing them twice.
+    Every job is recorded in job_store, and jobs left unfinished by a
+    previous run are queued again first, to resume where they left off.
+    Once in a while, old runs are archived, or deleted when the disk fills,
+    by the workspace on a thread of its own.
+    """
+    max_workers = max_workers or MAX_WORKERS or os.cpu_count() or 1
+    open_job_store()
+    in_flight = set()
+    finished = []
+    lock = threading.Lock()
+    scheduler = Scheduler()
+    running = 0
+
+    def dispatch():
+        # start waiting jobs while there are free workers
+        nonlocal running
+        while True:
+            with lock:
+                if running >= max_workers:
+                    return
+                contents = scheduler.pop()
+                if contents is None:
+                    return
+                running += 1
+            pool.submit(work, contents)
+
+    def work(contents):
+        nonlocal running
+        try:
+            return handle_message(contents)
+        finally:
+            with lock:
+                finished.append(contents['id'])
+                running -= 1
+            dispatch()
+
+    def mark_finished_as_read():
+        with lock:
+            msg_ids = finished[:]
+            del finished[:]
+        failures = {}
+        if msg_ids and not DEBUGGING:
+            failures = email_utils.BatchMarkAsRead(service, 'me', msg_ids)
+        for msg_id in msg_ids:
+            if msg_id in failures:
+                # try again next time around
+                print('Failed to mark message %s as read. Error: %s.' % (msg_id, failures[msg_id]))
+                with lock:
+                    finished.append(msg_id)
+            else:
+                in_flight.discard(msg_id)
+        return len(msg_ids)
+
+    sync = MailboxSync(service)
+    interval = PollInterval()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for contents in job_store.unfinished():
+            print('Resuming message %s...' % (contents['id'],))
+            in_flight.add(contents['id'])
+            scheduler.add(contents)
+
+        while (True):
+            # senders over their rate limit may have been held back
+            dispatch()
+            num_finished = mark_finished_as_read()
+            metrics.export()
+            workspace.maintain_in_background(job_finished)
+            with metrics.timer('gmail list'):
+                unread = sync.get_unread()
+            messages = [message for message in unread if message['id'] not in in_flight]
+
+            if len(messages) == 0:
+                # keep polling quickly while jobs are still finishing
+                seconds = interval.update(num_finished > 0 or len(in_flight) > 0)
+                print('No new messages to process. Sleeping for %d seconds.' % (seconds,))
+                sleep(seconds)
+            else:
+                print('%d new unread messages...' % (len(messages),))
+                contents, failures, _ = fetch_messages(service, [message['id'] for message in messages])
+                num_queued = 0
+                for message in messages:
+                    msg_id = message['id']
+                    if msg_id in failures:
+                        print('Failed to fetch message %s. Error: %s.' % (msg_id, failures[msg_id]))
+                        sync.defer(message)
+                    elif msg_id in contents:
+                        in_flight.add(msg_id)
+                        job_store.add(msg_id, contents[msg_id])
+                        scheduler.add(contents[msg_id])
+                        num_queued += 1
+                dispatch()
+
+                seconds = interval.update(True)
+                print('Queued %d messages on %d workers. Sleeping for %d seconds' % (num_queued, max_workers, seconds))
+                sleep(seconds)
+
+async def process_messages_async(service, max_workers=None):
+    """Event loop version of process_messages, which returns once stopped by
+    SIGINT or SIGTERM.
+
+    Polling, fetching and marking messages as read, and each job, are
+    concurrent tasks, and the RTKLIB tools of every job are started and
+    waited for by the event loop, so that network waits and solving overlap.
+    The calls to Gmail through service, which is not thread-safe, are made
+    one at a time on a thread of their own.  Jobs still run on up to
+    max_workers threads, to keep their processing unchanged, and no more
+    than ASYNC_QUEUE_SIZE fetched messages wait in a Scheduler for a free one,
+    not counting those of senders over their rate limit.  Messages of senders
+    with no rate limit to spare are left unfetched until they have, so the
+    jobs held back are only ever ones resumed from job_store.
+
+    When stopped, no new jobs are started, and the running ones are finished
+    and marked as read.  Jobs which had not started stay unread and are
+    resumed from job_store next time.
+    """
+    max_workers = max_workers or MAX_WORKERS or os.cpu_count() or 1
+    open_job_store()
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    jobs = {}
+    finished = []
+    scheduler = Scheduler()
+    job_pool = ThreadPoolExecutor(max_workers=max_workers)
+    gmail_pool = ThreadPoolExecutor(max_workers=1)
+
+    def gmail(func, *args):
+        return loop.run_in_executor(gmail_pool, func, *args)
+
+    async def work(contents):
+        try:
+            await loop.run_in_executor(job_pool, handle_message, contents)
+        except asyncio.CancelledError:
+            # never started, so left unread
+            return
+        finished.append(contents['id'])
+        # once this task is done, so that its worker counts as free
+        loop.call_soon(dispatch)
+
+    def running():
+        return sum(1 for task in jobs.values() if not task.done())
+
+    def dispatch():
+        # start waiting jobs while there are free workers
+        while not stopping.is_set() and running() < max_workers:
+            contents = scheduler.pop()
+            if contents is None:
+                return
+            jobs[contents['id']] = loop.create_task(work(contents))
+
+    async def mark_finished_as_read():
+        msg_ids = finished[:]
+        del finished[:]
+        failures = {}
+        if msg_ids and not DEBUGGING:
+            failures = await gmail(email_utils.BatchMarkAsRead, service, 'me', msg_ids)
+        for msg_id in msg_ids:
+            if msg_id in failures:
+                print('Failed to mark message %s as read. Error: %s.' % (msg_id, failures[msg_id]))
+                finished.append(msg_id)
+            else:
+                jobs.pop(msg_id, None)
+        return len(msg_ids)
+
+    async def wait(seconds):
+        # sleep, but wake up as soon as asked to stop
+        try:
+            await asyncio.wait_for(stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    signals = (signal.SIGINT, signal.SIGTERM) if threading.current_thread() is threading.main_thread() else ()
+    for signum in signals:
+        try:
+            loop.add_signal_handler(signum, stopping.set)
+        except NotImplementedError:
+            # windows
+            signal.signal(signum, lambda *args: loop.call_soon_threadsafe(stopping.set))
+
+    sync = MailboxSync(service)
+    interval = PollInterval()
+    proc_utils.use_event_loop(loop)
+    try:
+        for contents in job_store.unfinished():
+            print('Resuming message %s...' % (contents['id'],))
+            scheduler.add(contents)
+
+        while not stopping.is_set():
+            # senders over their rate limit may have been held back
+            dispatch()
+            num_finished = await mark_finished_as_read()
+            metrics.export()
+            workspace.maintain_in_background(job_finished)
+            busy = num_finished > 0 or len(jobs) > 0 or scheduler.num_ready() > 0
+            # jobs held back by a rate limit do not take up room, so that one sender cannot block the others
+            capacity = max_workers + ASYNC_QUEUE_SIZE - running() - scheduler.num_ready()
+            if capacity <= 0:
+                await wait(interval.update(True))
+                continue
 
-            print('Processed %d messages in this run. Sleeping for 10 seconds' % (num_processed,))
-            sleep(10)
+            with metrics.timer('gmail list'):
+                unread = await gmail(sync.get_unread)
+            messages = [message for message in unread if message['id'] not in jobs and message['id'] not in scheduler]
+            # leave the rest to be offered again once there is room for them
+            for message in messages[capacity:]:
+                sync.defer(message)
+            messages = messages[:capacity]
+
+            if messages:
+                print('%d new unread messages...' % (len(messages),))
+                contents, failures, held = await gmail(fetch_messages, service,
+                    [message['id'] for message in messages], scheduler.over_limit)
+                for message in messages:
+                    msg_id = message['id']
+                    if msg_id in failures:
+                        print('Failed to fetch message %s. Error: %s.' % (msg_id, failures[msg_id]))
+                        sync.defer(message)
+                    elif msg_id in held:
+                        # fetched once its sender is within their rate limit again
+                        sync.defer(message)
+                    elif msg_id in contents:
+                        job_store.add(msg_id, contents[msg_id])
+                        scheduler.add(contents[msg_id])
+                dispatch()
+                # messages only waiting on a rate limit are no reason to poll quickly
+                busy = busy or len(held) < len(messages)
+            await wait(interval.update(busy))
+    finally:
+        print('Stopping after %d running jobs finish.' % (running(),))
+        job_pool.shutdown(wait=False, cancel_futures=True)
+        if jobs:
+            await asyncio.wait(list(jobs.values()))
+        await mark_finished_as_read()
+        metrics.export()
+        proc_utils.use_event_loop(None)
+        gmail_pool.shutdown()
+        for signum in signals:
+            try:
+                loop.remove_signal_handler(signum)
+            except NotImplementedError:
+                signal.signal(signum, signal.SIG_DFL)
 
 def authorize_and_process():
-    credentials = get_credentials()
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('gmail', 'v1', http=http)
-    process_messages(service)
+    service = build_service()
+    if ASYNC_ENGINE:
+        asyncio.run(process_messages_async(service))
+    else:
+        process_messages(service)
 
 def run_continuously():
-    try:
-        authorize_and_process()
-    except Exception as e:
-        log_error(e, 'Error in authorization or message listing:')
-        print('Sleeping for 10 seconds.')
-        sleep(10)
-        run_continuously()
+    # unfinished jobs are resumed from job_store each time around
+    open_job_store()
+    while (True):
+        try:
+            # only returns once asked to stop
+            authorize_and_process()
+            return
+        except Exception as e:
+            log_error(e, 'Error in authorization or message listing:')
+            print('Sleeping for 10 seconds.')
+            sleep(10)
         
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+"""Durable record of each message's job and the stages it has completed, so
+that after a crash or restart jobs resume where they left off.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from my_constants import JOB_DB_FILE
+
+# stages checkpointed for each job, in order
+STAGES = ('fetched', 'unzipped', 'converted', 'solved', 'plotted', 'replied')
+
+# job statuses, a job is finished once it is done or failed
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    msg_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    contents TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    msg_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    finished REAL NOT NULL,
+    PRIMARY KEY (msg_id, stage)
+);
+"""
+
+
+class JobStore(object):
+    """SQLite database of jobs, keyed by message id.
+
+    Each job keeps the fetched message, so it can be resumed without
+    fetching it again, and the outputs of each stage it has completed.
+    One connection is shared by all threads, one statement at a time.
+
+    Args:
+      filename: Database file, created if it does not exist.
+    """
+    def __init__(self, filename=JOB_DB_FILE):
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            # the write-ahead log lets a checkpoint commit without rewriting the database
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(SCHEMA)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def add(self, msg_id, contents):
+        """Record a new job, leaving any existing job for the message as it is."""
+        now = time.time()
+        self.execute('INSERT OR IGNORE INTO jobs (msg_id, status, contents, created, updated) VALUES (?, ?, ?, ?, ?)',
+            (msg_id, QUEUED, json.dumps(contents), now, now))
+
+    def status(self, msg_id):
+        rows = self.execute('SELECT status FROM jobs WHERE msg_id = ?', (msg_id,))
+        return rows[0][0] if rows else None
+
+    def set_status(self, msg_id, status, error=None):
+        self.execute('UPDATE jobs SET status = ?, error = ?, updated = ? WHERE msg_id = ?',
+            (status, error, time.time(), msg_id))
+
+    def unfinished(self):
+        """List of the fetched messages of jobs which are neither done nor failed, oldest first."""
+        rows = self.execute('SELECT contents FROM jobs WHERE status IN (?, ?) ORDER BY created', (QUEUED, RUNNING))
+        return [json.loads(row[0]) for row in rows]
+
+    def checkpoint(self, msg_id, stage, outputs=None, path_names=(), job_dir=None):
+        """Record that a stage of a job is complete, with its outputs.
+
+        Args:
+          outputs: Dictionary of outputs (anything json can encode).
+          path_names: Names of the outputs which are paths of files or
+            directories, or lists of them, which must still exist for the
+            stage to count as complete.
+          job_dir: Directory of the job, which the paths are stored relative
+            to, so that they survive the directory being moved.
+        """
+        outputs = dict(outputs or {})
+        for name in path_names:
+            outputs[name] = map_paths(outputs[name], lambda path: os.path.relpath(path, job_dir))
+        self.execute('INSERT OR REPLACE INTO checkpoints (msg_id, stage, outputs, finished) VALUES (?, ?, ?, ?)',
+            (msg_id, stage, json.dumps({'outputs': outputs, 'paths': list(path_names)}), time.time()))
+        self.execute('UPDATE jobs SET updated = ? WHERE msg_id = ?', (time.time(), msg_id))
+
+    def checkpoints(self, msg_id, job_dir=None):
+        """Returns a dictionary mapping each completed stage of a job to its outputs,
+        with their paths in job_dir.
+
+        A stage only counts as complete if all of the stages before it are,
+        and the paths among their outputs still exist.
+        """
+        rows = dict(self.execute('SELECT stage, outputs FROM checkpoints WHERE msg_id = ?', (msg_id,)))
+        completed = {}
+        for stage in STAGES:
+            if stage not in rows:
+                break
+            record = json.loads(rows[stage])
+            outputs = record['outputs']
+            for name in record['paths']:
+                outputs[name] = map_paths(outputs[name], lambda path: os.path.normpath(os.path.join(job_dir or '.', path)))
+            if not all(os.path.exists(path) for name in record['paths'] for path in as_paths(outputs[name])):
+                break
+            completed[stage] = outputs
+        return completed
+
+
+def as_paths(value):
+    # a path output is a path or a list of paths
+    return [value] if isinstance(value, str) else list(value)
+
+
+def map_paths(value, func):
+    return func(value) if isinstance(value, str) else [func(path) for path in value]
@@ -7,6 +7,10 @@ from my_constants import MY_EMAIL
 import time
 import sys
 import linecache
+import threading
+
+# messages are processed on several threads, so serialize writes to the log
+log_lock = threading.Lock()
 
 class DataException(Exception):
     pass
@@ -29,7 +33,7 @@ def log_error(e, prefix, service=None):
     print(msg, file=sys.stderr)
 
     # put message in actual error log
-    with open('error_log.txt', 'a') as error_log:
+    with log_lock, open('error_log.txt', 'a') as error_log:
         error_log.write(msg)
 
     # write email to make error more visible
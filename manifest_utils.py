@@ -0,0 +1,239 @@
+"""Find the rover and base observations and the navigation files of a job.
+
+Each directory is listed with a single os.scandir pass, and listed again
+only once its modification time shows that files were added or removed.
+The kind of each file is read from its header rather than guessed from
+its name: RINEX files give their type and marker name, and u-blox binary
+files, if not named .ubx, must start with UBX_FRAMES well-formed messages,
+each the sync bytes 0xB5 0x62, class, id, length, payload and checksum.  The name is only
+used where the header does not say which receiver a file came from.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import os
+import re
+import threading
+import time
+
+from log_utils import DataException
+
+# kinds of file
+UBX = 'ubx'
+OBS = 'obs'
+NAV = 'nav'
+
+# bytes read from the start of each file to find out its kind
+SNIFF_BYTES = 4096
+UBX_SYNC = b'\xb5\x62'
+# consecutive valid frames a file must start with to count as u-blox binary
+UBX_FRAMES = 3
+# files which are never receiver data: zip, jpeg, png, gif and pdf
+NOT_DATA_MAGIC = (b'PK\x03\x04', b'\xff\xd8\xff', b'\x89PNG', b'GIF8', b'%PDF')
+BINARY_EXTS = ('.ubx',)
+OBS_RE = re.compile(r'^\.(obs|\d+o)$')
+NAV_RE = re.compile(r'^\.(\w*nav|\d+[ngh]|17g)$')
+# RINEX file types which hold navigation messages (2.x uses a letter per system)
+NAV_TYPES = 'NGHLJ'
+# directories modified more recently than this are listed again regardless
+RACY_NS = 2 * 10 ** 9
+
+
+class FileInfo(object):
+    """What the header of a file says about it.
+
+    Attributes:
+      path: Path of the file.
+      kind: UBX, OBS, NAV or None for anything else.
+      marker: Marker name of a RINEX observation file, or ''.
+      size: Size in bytes.
+    """
+    def __init__(self, path, kind, marker, size):
+        self.path = path
+        self.kind = kind
+        self.marker = marker
+        self.size = size
+
+    def describe(self):
+        name = os.path.basename(self.path)
+        if self.kind == OBS and self.marker:
+            return '%s (obs, marker %s)' % (name, self.marker)
+        return '%s (%s)' % (name, self.kind or 'unknown')
+
+
+def is_ubx(f):
+    # whether the open file starts with UBX_FRAMES frames with good checksums,
+    # or fewer if the file ends after them
+    f.seek(0)
+    for i in range(UBX_FRAMES):
+        header = f.read(6)
+        if i and not header:
+            return True
+        if len(header) < 6 or header[:2] != UBX_SYNC:
+            return False
+        length = header[4] | header[5] << 8
+        body = header[2:] + f.read(length)
+        checksum = f.read(2)
+        if len(body) < length + 4 or len(checksum) < 2:
+            return False
+        ck_a = ck_b = 0
+        for byte in body:
+            ck_a = (ck_a + byte) & 0xff
+            ck_b = (ck_b + ck_a) & 0xff
+        if checksum != bytes((ck_a, ck_b)):
+            return False
+    return True
+
+
+def sniff(path):
+    """Returns (kind, marker) from the first SNIFF_BYTES of a file."""
+    ext = os.path.splitext(path.lower())[1]
+    if ext in BINARY_EXTS:
+        return (UBX, '')
+    with open(path, 'rb') as f:
+        head = f.read(SNIFF_BYTES)
+        if head.startswith(NOT_DATA_MAGIC):
+            return (None, '')
+        if is_ubx(f):
+            return (UBX, '')
+    kind = None
+    marker = ''
+    for line in head.split(b'\n')[:100]:
+        label = line[60:].strip()
+        if label == b'RINEX VERSION / TYPE':
+            file_type = line[20:21].decode('ascii', 'replace').upper()
+            if file_type == 'O':
+                kind = OBS
+            elif file_type in NAV_TYPES:
+                kind = NAV
+            else:
+                # meteorological, clock and other RINEX files are not used
+                return (None, '')
+        elif label == b'MARKER NAME':
+            marker = line[:60].decode('ascii', 'replace').strip()
+        elif label == b'END OF HEADER':
+            break
+    if kind:
+        return (kind, marker)
+    # headers cut short by SNIFF_BYTES, or files without headers
+    if OBS_RE.match(ext):
+        return (OBS, '')
+    if NAV_RE.match(ext):
+        return (NAV, '')
+    return (None, '')
+
+
+def role_from_text(text, lenient=False):
+    # True for rover, False for base and None if text does not say; 'rov' and
+    # 'base' are clear enough, while a lone 'r' or 'b' is a last resort
+    text = text.lower()
+    if 'rov' in text:
+        return True
+    if 'base' in text or 'ref' in text:
+        return False
+    if lenient:
+        if 'r' in text:
+            return True
+        if 'b' in text:
+            return False
+    return None
+
+
+def split_rover_base(files):
+    """Returns the (rover, base) FileInfo among files of one kind, or None for either.
+
+    The marker name decides first, then the file name, and if only one of
+    two files is decided that way the other is taken to be the other receiver.
+    """
+    def name(info):
+        return os.path.splitext(os.path.basename(info.path))[0]
+    roles = []
+    for info in files:
+        role = role_from_text(info.marker)
+        if role is None:
+            role = role_from_text(name(info))
+        roles.append(role)
+    if len(files) == 2 and roles.count(None) == 1:
+        known = roles[0] if roles[1] is None else roles[1]
+        roles = [not known if role is None else role for role in roles]
+    roles = [role_from_text(name(info), lenient=True) if role is None else role
+             for info, role in zip(files, roles)]
+    rover = next((info for info, role in zip(files, roles) if role is True), None)
+    base = next((info for info, role in zip(files, roles) if role is False), None)
+    return (rover, base)
+
+
+class Manifest(object):
+    """The files of the directories of one job, shared by all of its stages."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # dirname -> (mtime_ns, list of FileInfo)
+        self.dirs = {}
+        # path -> ((size, mtime_ns), kind, marker)
+        self.sniffed = {}
+
+    def files(self, dirname, kind=None):
+        """FileInfo of the files in dirname, of the given kind if any, sorted by name."""
+        with self.lock:
+            mtime = os.stat(dirname).st_mtime_ns
+            # a directory may change again without its coarse modification time moving on
+            if dirname not in self.dirs or self.dirs[dirname][0] != mtime or time.time_ns() - mtime < RACY_NS:
+                self.dirs[dirname] = (mtime, self.scan(dirname))
+            files = self.dirs[dirname][1]
+        return [info for info in files if kind is None or info.kind == kind]
+
+    def scan(self, dirname):
+        files = []
+        for entry in sorted(os.scandir(dirname), key=lambda entry: entry.name):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            if entry.path not in self.sniffed or self.sniffed[entry.path][0] != stamp:
+                self.sniffed[entry.path] = (stamp,) + sniff(entry.path)
+            _, kind, marker = self.sniffed[entry.path]
+            files.append(FileInfo(entry.path, kind, marker, stat.st_size))
+        return files
+
+    def found(self, dirname):
+        return ', '.join(info.describe() for info in self.files(dirname) if info.kind) or 'nothing usable'
+
+    def binary_files(self, dirname):
+        """Returns the paths of the rover and base u-blox files, or None for either."""
+        rover, base = split_rover_base(self.files(dirname, UBX))
+        return (rover and rover.path, base and base.path)
+
+    def obs_file(self, dirname, is_rover):
+        rover, base = split_rover_base(self.files(dirname, OBS))
+        info = rover if is_rover else base
+        return info and info.path
+
+    def nav_files(self, dirname, rover_obs):
+        # take files with the same name as rover obs if they exist,
+        # otherwise take whatever nav files can be found
+        nav_files = [info.path for info in self.files(dirname, NAV)]
+        rover_name = os.path.splitext(os.path.basename(rover_obs))[0] + '.'
+        same_name = [path for path in nav_files if os.path.basename(path).startswith(rover_name)]
+        return same_name or nav_files
+
+    def input_files(self, rover_dir, base_dir):
+        """Returns the rover and base observations and the navigation files to go with them.
+
+        Raises:
+          DataException naming the files that were found, if any are missing.
+        """
+        rover_obs = self.obs_file(rover_dir, True)
+        if not rover_obs:
+            raise DataException('Could not detect rover observation file (even after running convbin if '
+                'necessary). Found: %s.' % (self.found(rover_dir),))
+        base_obs = self.obs_file(base_dir, False)
+        if not base_obs:
+            raise DataException('Could not detect base observation file (even after running convbin if '
+                'necessary). Found: %s.' % (self.found(base_dir),))
+        nav_files = self.nav_files(rover_dir, rover_obs)
+        if len(nav_files) == 0:
+            raise DataException('Could not find any navigation files (even after running convbin if '
+                'necessary). Found: %s.' % (self.found(rover_dir),))
+        return (rover_obs, base_obs, nav_files)
@@ -0,0 +1,224 @@
+"""Time the stages of each job and export the measurements.
+
+Counters and histograms are written in the Prometheus text format, for
+the node exporter's textfile collector, and each measurement is also
+appended to a JSON lines file.  When disabled, timers cost one attribute
+lookup and a no-op context manager.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+from my_constants import (METRICS_ENABLED, METRICS_PROM_FILE, METRICS_JSONL_FILE, PROFILE_JOB,
+    SECONDS_BUCKETS, BYTES_BUCKETS, EPOCHS_BUCKETS)
+
+# histogram buckets for each metric observed, by the unit at the end of its name
+BUCKETS = {'seconds': SECONDS_BUCKETS, 'bytes': BYTES_BUCKETS, 'epochs': EPOCHS_BUCKETS}
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in labels),)
+
+
+class Metrics(object):
+    """Counters and histograms of the stages of jobs.
+
+    Measurements are labelled with the job that made them, which is the job
+    set with job() on the calling thread unless one is given.
+
+    Args:
+      enabled: If False, nothing is measured or written.
+      prom_file: Prometheus text file rewritten by export().
+      jsonl_file: File to which export() appends the measurements since the last export.
+      profile_job: Message id of a job to run under cProfile, or 'next' for
+        the next job to start.  The profile is saved to profile.pstats in
+        the job's directory.
+    """
+    def __init__(self, enabled=METRICS_ENABLED, prom_file=METRICS_PROM_FILE, jsonl_file=METRICS_JSONL_FILE,
+                 profile_job=PROFILE_JOB):
+        self.enabled = enabled
+        self.prom_file = prom_file
+        self.jsonl_file = jsonl_file
+        self.profile_job = profile_job
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.events = []
+        self.profiles = {}
+        self.thread_data = threading.local()
+
+    def current_job(self):
+        return getattr(self.thread_data, 'job', None)
+
+    @contextmanager
+    def job(self, job, dirname=None):
+        """Context manager labelling measurements on the calling thread with job.
+
+        If job is the one to profile, it runs under cProfile, along with any
+        functions wrapped by timed() for it.
+        """
+        previous = self.current_job()
+        self.thread_data.job = job
+        profile = None
+        if self.enabled and dirname and self.claim_profile(job):
+            profile = cProfile.Profile()
+            profile.enable()
+            with self.lock:
+                self.profiles[job] = [profile]
+        try:
+            yield
+        finally:
+            self.thread_data.job = previous
+            if profile:
+                profile.disable()
+                with self.lock:
+                    profiles = self.profiles.pop(job)
+                pstats.Stats(*profiles).dump_stats(os.path.join(dirname, 'profile.pstats'))
+
+    def claim_profile(self, job):
+        with self.lock:
+            if self.profile_job == 'next':
+                self.profile_job = job
+            return self.profile_job == job
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, job=None, **labels):
+        """Add value to the histogram name, whose buckets depend on its unit."""
+        if not self.enabled:
+            return
+        job = job or self.current_job()
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(BUCKETS[name.rsplit('_', 1)[-1]])
+            self.histograms[key].observe(value)
+            self.events.append({'time': time.time(), 'job': job, 'metric': name, 'labels': labels, 'value': value})
+
+    @contextmanager
+    def measure(self, stage, job=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.time() - start, job, stage=stage)
+
+    def timer(self, stage, job=None):
+        """Context manager adding the time it takes to the histogram stage_seconds."""
+        if not self.enabled:
+            return NULL_TIMER
+        return self.measure(stage, job)
+
+    def timed(self, stage, func, job=None):
+        """Wrap func to time it as stage of job, when run on any thread."""
+        if not self.enabled:
+            return func
+        job = job or self.current_job()
+        def run(*args, **kwargs):
+            previous = self.current_job()
+            self.thread_data.job = job
+            profile = None
+            with self.lock:
+                if job in self.profiles:
+                    profile = cProfile.Profile()
+                    try:
+                        profile.enable()
+                        self.profiles[job].append(profile)
+                    except ValueError:
+                        # from python 3.12 only one profiler can be active at a time
+                        profile = None
+            try:
+                with self.measure(stage, job):
+                    return func(*args, **kwargs)
+            finally:
+                if profile:
+                    profile.disable()
+                self.thread_data.job = previous
+        return run
+
+    def export(self):
+        """Rewrite the Prometheus file and append new measurements to the JSON lines file."""
+        if not self.enabled:
+            return
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, list(h.buckets), list(h.counts), h.sum, h.count)
+                          for key, h in sorted(self.histograms.items(), key=lambda item: item[0])]
+            events = self.events
+            self.events = []
+
+        lines = []
+        for (name, labels), value in counters:
+            lines.append('# TYPE rtklib_%s counter' % (name,))
+            lines.append('rtklib_%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), buckets, counts, total, count in histograms:
+            lines.append('# TYPE rtklib_%s histogram' % (name,))
+            cumulative = 0
+            for bound, n in zip(buckets + ['+Inf'], counts):
+                cumulative += n
+                lines.append('rtklib_%s_bucket%s %d' % (name, format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('rtklib_%s_sum%s %s' % (name, format_labels(labels), total))
+            lines.append('rtklib_%s_count%s %d' % (name, format_labels(labels), count))
+        # keep only the first TYPE line of each metric, which the format requires
+        seen = set()
+        lines = [line for line in lines if not (line.startswith('# TYPE') and (line in seen or seen.add(line)))]
+
+        for filename in (self.prom_file, self.jsonl_file):
+            dirname = os.path.dirname(filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        # replace the file in one step so the collector never reads half of it
+        tmp_file = self.prom_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, self.prom_file)
+        if events:
+            with open(self.jsonl_file, 'a') as f:
+                for event in events:
+                    f.write(json.dumps(event) + '\n')
+
+
+# shared by all modules, so that everything ends up in one export
+metrics = Metrics()
@@ -12,4 +12,115 @@ DEMO5_BIN_DIR = 'demo5_bin'
 ORIG_CONFIG_FILE = 'orig_config.conf'
 DEMO5_CONFIG_FILE = 'demo5_config.conf'
 
-DEBUGGING = False
\ No newline at end of file
+DEBUGGING = False
+
+# number of messages processed at once (None = one per cpu core)
+MAX_WORKERS = None
+
+# number of external tools run at once within one message
+MAX_STAGE_WORKERS = 4
+
+# gmail batch requests (gmail recommends no more than 50 requests per batch)
+GMAIL_BATCH_SIZE = 50
+GMAIL_BATCH_RETRIES = 3
+
+# polling for new messages
+INCREMENTAL_SYNC = True      # ask only for messages added since the last poll
+FULL_SYNC_INTERVAL = 3600    # seconds between full listings of unread messages
+POLL_INTERVAL_MIN = 2        # seconds between polls while there is traffic
+POLL_INTERVAL_MAX = 60       # seconds between polls once the mailbox is idle
+
+# attachment downloads
+ATTACHMENT_WORKERS = 4              # attachments downloaded at once
+DECODE_CHUNK_SIZE = 4 * 1024 * 1024 # characters of base64 decoded at a time
+
+# cache of tool outputs, keyed by a hash of the tool inputs
+USE_RESULT_CACHE = True
+CACHE_DIR = 'runs/cache'
+CACHE_MAX_BYTES = 2 * 1024**3
+
+# intervals longer than this many sample intervals count as gaps in the observations
+GAP_FACTOR = 1.5
+INDEX_CHUNK_SIZE = 16 * 1024**2 # bytes of an observation file searched for epochs at a time
+MIN_RATE_RUN = 10               # epochs a new sample interval must last to count as a rate change
+
+# draw plots in-process with numpy and matplotlib instead of rtkplot.exe, if they are installed
+NATIVE_PLOTS = True
+
+# gmail api client
+DISCOVERY_CACHE_FILE = 'gmail_discovery.json' # local copy of the api discovery document
+DISCOVERY_MAX_AGE = 7 * 24 * 3600             # seconds before the local copy is fetched again
+TOKEN_REFRESH_MARGIN = 300                    # seconds before expiry at which access tokens are refreshed
+
+# replies with more than this many bytes of attachments are sent by upload from a temporary file
+RAW_SEND_LIMIT = 1024 * 1024
+MEASURE_REPLY_MEMORY = False # print the peak memory used to send each reply
+
+# reply size, gmail refuses messages over 25 MB once encoded
+REPLY_SIZE_BUDGET = 20 * 1024 * 1024 # bytes of encoded attachments per reply
+ZIP_THRESHOLD = 256 * 1024           # attached files larger than this are zipped
+JPEG_QUALITIES = (85, 70, 50, 35)    # qualities tried in turn for inline plots while over budget
+
+# durable record of jobs and their completed stages, for resuming after a restart
+JOB_DB_FILE = 'runs/jobs.db'
+
+# timing of the stages of each job
+METRICS_ENABLED = True
+METRICS_PROM_FILE = 'runs/metrics.prom'    # rewritten after each poll, for the node exporter textfile collector
+METRICS_JSONL_FILE = 'runs/metrics.jsonl'  # every measurement, one json object per line
+PROFILE_JOB = None                         # message id of a job to run under cProfile, or 'next'
+SECONDS_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800]
+BYTES_BUCKETS = [2**n for n in range(16, 32, 2)]
+EPOCHS_BUCKETS = [100, 1000, 3600, 10000, 36000, 100000, 360000]
+
+# limits on the rtklib executables, by file name
+TOOL_TIMEOUTS = {'convbin.exe': 600, 'rnx2rtkp.exe': 3600, 'rtkplot.exe': 120} # seconds before a run is killed
+TOOL_CPU_LIMITS = {'convbin.exe': 600, 'rnx2rtkp.exe': 3600, 'rtkplot.exe': 120} # cpu seconds, posix only
+TOOL_MEMORY_LIMIT = 4 * 1024 * 1024 * 1024 # bytes of address space per run, posix only
+TOOL_CONCURRENCY = {'convbin.exe': 4, 'rnx2rtkp.exe': None, 'rtkplot.exe': 2} # runs at once, None for one per cpu
+TOOL_NICE = 5                              # nice level of the tools, posix only
+TOOL_CPUS = None                           # set of cpu numbers to run the tools on, linux only
+
+# observation files longer than this many seconds are solved in time slices in parallel, 0 to never slice
+SLICE_MIN_DURATION = 4 * 3600
+SLICE_SECONDS = 3600      # seconds of solution kept from each slice
+SLICE_OVERLAP = 600       # seconds each slice starts early, for the filter to converge
+SLICE_WORKERS = 4         # slices solved at once for each solution
+SLICE_VALIDATE = False    # also solve in a single pass and report how the solutions compare
+
+# settings given several values separated by '|' are solved with each combination of them
+SWEEP_MAX_VARIANTS = 16
+SWEEP_WORKERS = 4
+
+# poll gmail, run jobs and their tools from an asyncio event loop instead of a plain thread pool
+ASYNC_ENGINE = False
+ASYNC_QUEUE_SIZE = 4 # fetched messages waiting for a free worker
+
+# runs/ workspace
+WORKSPACE_HOT_DAYS = 7             # finished runs younger than this are left as they are
+WORKSPACE_KEEP = 'all'             # 'all', or 'results' to archive only WORKSPACE_RESULT_EXTS
+WORKSPACE_RESULT_EXTS = ('.pos', '.conf')
+WORKSPACE_HIGH_WATER = 0.90        # fraction of the disk in use that starts deleting old runs
+WORKSPACE_LOW_WATER = 0.80         # and that stops it
+WORKSPACE_MAX_BYTES = None         # or a size for runs/ to be kept under, as well as the disk
+WORKSPACE_TMPFS = None             # eg '/dev/shm/rtklib_runs', for runs in progress
+WORKSPACE_TMPFS_MIN_FREE = 512 * 1024 * 1024
+WORKSPACE_CHECK_INTERVAL = 3600    # seconds between tidying up runs/
+
+# order of the waiting messages: shortest first, shared fairly between senders
+SCHEDULE_JOB_OVERHEAD = 2 * 1024 * 1024      # bytes of attachment a job costs even without data
+SCHEDULE_ZIP_FACTOR = 3                      # zipped attachments count this many times their size
+SCHEDULE_AGING_RATE = 100 * 1024             # bytes of cost forgiven for every second waited
+SCHEDULE_MAX_WAIT = 1800                     # seconds after which a job goes ahead of all newer ones
+SCHEDULE_FAIR_HALF_LIFE = 3600               # seconds for the share of a sender's earlier jobs to halve
+SCHEDULE_SENDER_PER_HOUR = 20                # jobs each sender may start an hour, None for no limit
+SCHEDULE_SENDER_BURST = 10                   # jobs each sender may start at once
+
+# unread messages are listed with this query, and only their headers fetched until they are known to be wanted;
+# Gmail's subject: operator matches whole words, so the subject is checked for PROCESS_SUBJECT afterwards
+UNREAD_QUERY = 'is:unread'
+TRIAGE_HEADERS = ['Subject', 'From', 'Message-ID']
+TRIAGE_FIELDS = 'id,threadId,labelIds,payload/headers'
+
+# a line like "quicklook=1" in the body asks for solutions from the observations thinned to one epoch a second
+QUICKLOOK_OPTION = 'quicklook'
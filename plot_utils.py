@@ -0,0 +1,216 @@
+"""Plot RTKLIB solution and RINEX observation files without rtkplot.exe.
+
+Requires numpy and matplotlib; available is False if they are missing.
+Run directly to compare the time taken against rtkplot.exe:
+
+    python plot_utils.py out_demo5.pos rover.obs [repeats]
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import calendar
+import os
+import time
+
+try:
+    import numpy as np
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    available = True
+except ImportError:
+    available = False
+
+from rinex_utils import EpochIndex
+from my_constants import GAP_FACTOR
+
+# gps time started at 1980/1/6
+GPS_EPOCH = calendar.timegm((1980, 1, 6, 0, 0, 0))
+
+# solution quality flags and the colors rtkplot uses for them
+QUALITY_COLORS = [
+    (1, 'fix', '#00c000'),
+    (2, 'float', '#e0c000'),
+    (3, 'sbas', '#ff00ff'),
+    (4, 'dgps', '#0000ff'),
+    (5, 'single', '#ff0000'),
+    (6, 'ppp', '#00ffff'),
+]
+
+SYSTEM_COLORS = {'G': '#00a000', 'R': '#a000a0', 'E': '#0060ff', 'C': '#c06000',
+                 'J': '#00a0a0', 'S': '#808080', 'I': '#a0a000'}
+
+
+def read_pos_file(filename):
+    """Read an RTKLIB solution file.
+
+    Handles solutions in enu, llh and xyz format, with times in either
+    calendar (hms) or week and time of week (tow) format.
+
+    Returns:
+      Dictionary of arrays: 'time' (seconds since 1970), 'e', 'n', 'u'
+      (meters from the mean position for llh and xyz solutions), 'q'
+      (quality flag) and 'ns' (number of satellites).
+    """
+    header = ''
+    lines = []
+    with open(filename) as pos_file:
+        for line in pos_file:
+            if line.startswith('%'):
+                header = line
+            elif line.strip():
+                lines.append(line)
+    if not lines:
+        return dict((key, np.zeros(0)) for key in ('time', 'e', 'n', 'u', 'q', 'ns'))
+
+    if '/' in lines[0].split()[0]:
+        # "2017/03/15 12:00:00.000" then the solution
+        times = np.array([line[:23].replace('/', '-').replace(' ', 'T') for line in lines],
+                         dtype='datetime64[ms]').astype(np.int64) / 1000.0
+        values = np.loadtxt(lines, usecols=(2, 3, 4, 5, 6), ndmin=2)
+    else:
+        # "1946 302400.000" then the solution
+        values = np.loadtxt(lines, usecols=(0, 1, 2, 3, 4, 5, 6), ndmin=2)
+        times = GPS_EPOCH + values[:, 0] * 604800 + values[:, 1]
+        values = values[:, 2:]
+
+    x, y, z = values[:, 0], values[:, 1], values[:, 2]
+    if 'latitude' in header:
+        # degrees to meters relative to the mean, close enough for a plot
+        lat0 = np.radians(np.mean(x))
+        e = np.radians(y - np.mean(y)) * 6378137.0 * np.cos(lat0)
+        n = np.radians(x - np.mean(x)) * 6378137.0
+        u = z - np.mean(z)
+    elif 'x-ecef' in header:
+        e, n, u = ecef_to_enu(x, y, z)
+    else:
+        e, n, u = x, y, z
+    return {'time': times, 'e': e, 'n': n, 'u': u, 'q': values[:, 3].astype(int), 'ns': values[:, 4].astype(int)}
+
+
+def ecef_to_enu(x, y, z):
+    # rotate the offsets from the mean position into the local frame there
+    x0, y0, z0 = np.mean(x), np.mean(y), np.mean(z)
+    lon = np.arctan2(y0, x0)
+    lat = np.arctan2(z0, np.hypot(x0, y0))
+    dx, dy, dz = x - x0, y - y0, z - z0
+    e = -np.sin(lon) * dx + np.cos(lon) * dy
+    n = -np.sin(lat) * np.cos(lon) * dx - np.sin(lat) * np.sin(lon) * dy + np.cos(lat) * dz
+    u = np.cos(lat) * np.cos(lon) * dx + np.cos(lat) * np.sin(lon) * dy + np.sin(lat) * dz
+    return (e, n, u)
+
+
+def new_figure():
+    # figures are not tied to pyplot, which is not thread-safe
+    fig = Figure(figsize=(10, 7.5), dpi=80)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def hours(times, t0):
+    return (times - t0) / 3600.0
+
+
+def plot_solution(sln_file, plot_file):
+    """Plot the east, north and up positions of a solution against time, colored by quality."""
+    sol = read_pos_file(sln_file)
+    fig = new_figure()
+    t0 = sol['time'][0] if len(sol['time']) else 0
+    x = hours(sol['time'], t0)
+    num_fix = np.count_nonzero(sol['q'] == 1)
+    for i, key in enumerate(('e', 'n', 'u')):
+        ax = fig.add_subplot(3, 1, i + 1)
+        for q, name, color in QUALITY_COLORS:
+            is_q = sol['q'] == q
+            if np.any(is_q):
+                ax.plot(x[is_q], sol[key][is_q], '.', color=color, markersize=2, label=name)
+        ax.set_ylabel('%s (m)' % (key.upper(),))
+        ax.grid(True, color='#e0e0e0')
+        if i == 0:
+            ax.set_title('%s: %d epochs, %.1f%% fixed' % (os.path.basename(sln_file), len(x),
+                100.0 * num_fix / max(len(x), 1)))
+            ax.legend(loc='upper right', markerscale=4, fontsize='small')
+    ax.set_xlabel('hours from %s GPST' % (format_time(t0),))
+    fig.savefig(plot_file)
+
+
+def plot_observations(obs_file, plot_file):
+    """Plot which satellites were observed when, with cycle slips marked in red."""
+    with EpochIndex(obs_file) as index:
+        times = index.times
+        epochs, sats, slips = index.satellite_obs()
+    fig = new_figure()
+    ax = fig.add_subplot(1, 1, 1)
+    t0 = times[0] if len(times) else 0
+    names = []
+    if len(epochs):
+        sat_ids = np.unique(sats)
+        rows = np.searchsorted(sat_ids, sats)
+        names = ['%s%02d' % (chr(sat // 100), sat % 100) for sat in sat_ids]
+        order = np.lexsort((epochs, rows))
+        rows, epochs, slips = rows[order], epochs[order], slips[order]
+        # draw runs of consecutive epochs as single lines, broken at gaps in time
+        is_gap = np.zeros(len(times), dtype=bool)
+        if len(times) > 1:
+            intervals = np.diff(times)
+            is_gap[:-1] = intervals > GAP_FACTOR * np.median(intervals)
+        breaks = np.flatnonzero((np.diff(rows) != 0) | (np.diff(epochs) != 1) | is_gap[epochs[:-1]]) + 1
+        firsts = np.r_[0, breaks]
+        lasts = np.r_[breaks, len(rows)] - 1
+        colors = [SYSTEM_COLORS.get(name[0], '#000000') for name in names]
+        ax.hlines(rows[firsts], hours(times[epochs[firsts]], t0), hours(times[epochs[lasts]], t0),
+                  colors=[colors[row] for row in rows[firsts]], linewidth=3)
+        ax.plot(hours(times[epochs[slips]], t0), rows[slips], '|', color='#ff0000', markersize=8)
+    ax.set_yticks(range(len(names)))
+    ax.set_yticklabels(names, fontsize='x-small')
+    ax.set_ylim(-1, len(names))
+    ax.invert_yaxis()
+    ax.grid(True, axis='x', color='#e0e0e0')
+    ax.set_title('%s: %d epochs, %d satellites' % (os.path.basename(obs_file), len(times), len(names)))
+    ax.set_xlabel('hours from %s GPST' % (format_time(t0),))
+    fig.savefig(plot_file)
+
+
+def format_time(seconds):
+    return time.strftime('%Y/%m/%d %H:%M:%S', time.gmtime(seconds))
+
+
+def save_image(data_file, plot_file):
+    """Plot a solution or observation file, whichever data_file is."""
+    if data_file.lower().endswith('.pos'):
+        plot_solution(data_file, plot_file)
+    else:
+        plot_observations(data_file, plot_file)
+
+
+if __name__ == '__main__':
+    import subprocess
+    import sys
+    import tempfile
+
+    from my_constants import DEMO5_BIN_DIR
+
+    # each job plots two solutions and two observation files
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    tmp_dir = tempfile.mkdtemp()
+    exe_file = os.path.join(DEMO5_BIN_DIR, 'rtkplot.exe')
+    per_job = {'native': 0, 'rtkplot.exe': 0}
+
+    for data_file in sys.argv[1:3]:
+        plot_file = os.path.join(tmp_dir, os.path.basename(data_file) + '.jpg')
+        start = time.time()
+        for i in range(repeats):
+            save_image(data_file, plot_file)
+        per_job['native'] += 2 * (time.time() - start) / repeats
+        if os.path.exists(exe_file):
+            start = time.time()
+            for i in range(repeats):
+                subprocess.call([exe_file, '-s', os.path.abspath(plot_file), os.path.abspath(data_file)])
+            per_job['rtkplot.exe'] += 2 * (time.time() - start) / repeats
+
+    print('native plots: %.3f s per job' % (per_job['native'],))
+    if os.path.exists(exe_file):
+        print('rtkplot.exe: %.3f s per job' % (per_job['rtkplot.exe'],))
+    else:
+        print('rtkplot.exe: not found in %s' % (DEMO5_BIN_DIR,))
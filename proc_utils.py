@@ -0,0 +1,205 @@
+"""Run the RTKLIB executables with time, memory and concurrency limits.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import asyncio
+import os
+import subprocess
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from log_utils import DataException
+from metrics_utils import metrics
+from my_constants import (TOOL_TIMEOUTS, TOOL_CPU_LIMITS, TOOL_MEMORY_LIMIT, TOOL_CONCURRENCY,
+    TOOL_NICE, TOOL_CPUS)
+
+# how often a running tool is checked on
+POLL_SECONDS = 0.05
+
+
+class ToolRun(object):
+    """Outcome of one run of a tool.
+
+    Attributes:
+      returncode: Exit status, negative for the number of the signal that ended it.
+      wall_seconds: Time from starting the tool to its exit, not counting any
+        wait for a free slot.
+      wait_seconds: Time spent waiting for a free slot.
+      user_seconds, system_seconds: CPU time used, or None where unknown.
+      max_rss: Peak resident memory in kilobytes, or None where unknown.
+      stdout, stderr: Files holding the output of the tool.
+    """
+    def __init__(self, returncode, wall_seconds, wait_seconds, rusage, stdout, stderr):
+        self.returncode = returncode
+        self.wall_seconds = wall_seconds
+        self.wait_seconds = wait_seconds
+        self.user_seconds = rusage.ru_utime if rusage else None
+        self.system_seconds = rusage.ru_stime if rusage else None
+        self.max_rss = rusage.ru_maxrss if rusage else None
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+def tool_limit(tool):
+    return TOOL_CONCURRENCY.get(tool) or os.cpu_count() or 1
+
+
+semaphores = {}
+semaphores_lock = threading.Lock()
+
+def get_semaphore(tool):
+    with semaphores_lock:
+        if tool not in semaphores:
+            semaphores[tool] = threading.BoundedSemaphore(tool_limit(tool))
+        return semaphores[tool]
+
+
+# event loop which starts the tools instead of the calling thread, if any
+event_loop = None
+# only used on the event loop's thread, so needs no lock
+async_semaphores = {}
+
+def use_event_loop(loop):
+    """From now on, start and wait for the tools from loop (an asyncio event
+    loop running on another thread), or from the calling thread if None."""
+    global event_loop
+    event_loop = loop
+    async_semaphores.clear()
+
+
+def limit_process(pid, tool):
+    # applied just after the tool starts, since preexec_fn is not safe with threads
+    cpu_limit = TOOL_CPU_LIMITS.get(tool)
+    if hasattr(resource, 'prlimit'):
+        if cpu_limit:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 5))
+        if TOOL_MEMORY_LIMIT:
+            resource.prlimit(pid, resource.RLIMIT_AS, (TOOL_MEMORY_LIMIT, TOOL_MEMORY_LIMIT))
+    if TOOL_NICE and hasattr(os, 'setpriority'):
+        os.setpriority(os.PRIO_PROCESS, pid, TOOL_NICE)
+    if TOOL_CPUS and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, TOOL_CPUS)
+
+
+def wait_process(proc, start, timeout):
+    # returns the rusage of the process where the platform can tell, or None
+    if not hasattr(os, 'wait4'):
+        proc.wait(None if timeout is None else max(start + timeout - time.time(), 0))
+        return None
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return rusage
+        if timeout is not None and time.time() > start + timeout:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(POLL_SECONDS)
+
+
+def run_tool(args, log_dir, log_name, timeout=None):
+    """Run an executable, waiting for a free slot for it first.
+
+    At most TOOL_CONCURRENCY[tool] (default one per cpu) copies of each tool
+    run at once.  The tool is killed after TOOL_TIMEOUTS[tool] seconds, or
+    timeout if given.  Where the platform allows, its cpu time is limited to
+    TOOL_CPU_LIMITS[tool] seconds and its address space to TOOL_MEMORY_LIMIT
+    bytes, and it is run at nice level TOOL_NICE on cpus TOOL_CPUS.  After
+    use_event_loop, the run is handed to the event loop and waited for.
+
+    Args:
+      args: Command line, starting with the path of the executable.
+      log_dir: Directory for the files capturing the tool's output.
+      log_name: Name of those files, which end in .out and .err.
+      timeout: Seconds after which the tool is killed.
+
+    Raises:
+      DataException if the tool is killed for taking too long.
+
+    Returns:
+      ToolRun
+    """
+    if event_loop is not None:
+        return asyncio.run_coroutine_threadsafe(run_tool_async(args, log_dir, log_name, timeout,
+            metrics.current_job()), event_loop).result()
+
+    tool = os.path.basename(args[0])
+    timeout = timeout or TOOL_TIMEOUTS.get(tool)
+    stdout = os.path.join(log_dir, log_name + '.out')
+    stderr = os.path.join(log_dir, log_name + '.err')
+
+    wait_start = time.time()
+    with get_semaphore(tool):
+        start = time.time()
+        with open(stdout, 'wb') as out, open(stderr, 'wb') as err:
+            proc = subprocess.Popen(args, stdout=out, stderr=err)
+            try:
+                try:
+                    limit_process(proc.pid, tool)
+                except OSError:
+                    # the tool may already have exited
+                    pass
+                rusage = wait_process(proc, start, timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                raise DataException('%s was stopped after running for %g seconds.' % (tool, timeout))
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+    run = ToolRun(proc.returncode, time.time() - start, start - wait_start, rusage, stdout, stderr)
+    record_run(tool, run)
+    return run
+
+
+async def run_tool_async(args, log_dir, log_name, timeout=None, job=None):
+    """Coroutine version of run_tool, for use on an event loop.
+
+    The same limits apply, except that cpu time and peak memory are not
+    reported, since the event loop reaps the tool itself.
+    """
+    tool = os.path.basename(args[0])
+    timeout = timeout or TOOL_TIMEOUTS.get(tool)
+    stdout = os.path.join(log_dir, log_name + '.out')
+    stderr = os.path.join(log_dir, log_name + '.err')
+    if tool not in async_semaphores:
+        async_semaphores[tool] = asyncio.BoundedSemaphore(tool_limit(tool))
+
+    wait_start = time.time()
+    async with async_semaphores[tool]:
+        start = time.time()
+        with open(stdout, 'wb') as out, open(stderr, 'wb') as err:
+            proc = await asyncio.create_subprocess_exec(*args, stdout=out, stderr=err)
+            try:
+                try:
+                    limit_process(proc.pid, tool)
+                except OSError:
+                    pass
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise DataException('%s was stopped after running for %g seconds.' % (tool, timeout))
+            except BaseException:
+                proc.kill()
+                await proc.wait()
+                raise
+    run = ToolRun(proc.returncode, time.time() - start, start - wait_start, None, stdout, stderr)
+    record_run(tool, run, job)
+    return run
+
+
+def record_run(tool, run, job=None):
+    metrics.observe('stage_seconds', run.wall_seconds, job, stage=tool)
+    metrics.observe('tool_wait_seconds', run.wait_seconds, job, tool=tool)
+    if run.user_seconds is not None:
+        metrics.observe('tool_cpu_seconds', run.user_seconds + run.system_seconds, job, tool=tool)
+        metrics.observe('tool_rss_bytes', run.max_rss * 1024, job, tool=tool)
@@ -0,0 +1,104 @@
+"""Shrink reply attachments to fit within the mailbox size limits.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import os
+import shutil
+import zipfile
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from my_constants import REPLY_SIZE_BUDGET, ZIP_THRESHOLD, JPEG_QUALITIES
+
+
+def encoded_size(attachments):
+    # attachments are base64 encoded, which takes 4 bytes for every 3
+    return sum(os.path.getsize(attachment['path']) for attachment in attachments) * 4 // 3
+
+
+def zip_file(path, zip_path):
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_arch:
+        zip_arch.write(path, os.path.basename(path))
+
+
+def reencode_jpeg(path, new_path, quality):
+    with Image.open(path) as image:
+        image.convert('RGB').save(new_path, 'JPEG', quality=quality, optimize=True)
+
+
+def package_reply(attachments, dirname, budget=REPLY_SIZE_BUDGET):
+    """Compress and re-encode the attachments of a reply.
+
+    Files sent as attachments which are larger than ZIP_THRESHOLD are zipped.
+    Inline JPEG images are re-encoded at each of JPEG_QUALITIES in turn, for
+    as long as the reply is over budget.  If it still is, the largest files
+    sent as attachments are left out.  Inline images keep their file names,
+    since the html refers to them by name.
+
+    Args:
+      attachments: List of 'attachment' dictionaries, with 'path' and
+        'disposition' keys, as for CreateMessageWithAttachments.
+      dirname: Directory for the packaged files.
+      budget: Maximum encoded size of the attachments, in bytes.
+
+    Returns:
+      Tuple of the packaged attachments and an html table comparing
+      the original and packaged sizes.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    packaged = []
+    for attachment in attachments:
+        path = attachment['path']
+        if attachment['disposition'] == 'attachment' and os.path.getsize(path) > ZIP_THRESHOLD:
+            new_path = os.path.join(dirname, os.path.basename(path) + '.zip')
+            zip_file(path, new_path)
+        else:
+            new_path = os.path.join(dirname, os.path.basename(path))
+            shutil.copy(path, new_path)
+        packaged.append({'path': new_path, 'disposition': attachment['disposition'], 'original': path})
+
+    images = [attachment for attachment in packaged if attachment['disposition'] == 'inline'
+              and attachment['path'].lower().endswith(('.jpg', '.jpeg'))]
+    if Image:
+        for quality in JPEG_QUALITIES:
+            if encoded_size(packaged) <= budget:
+                break
+            for image in images:
+                reencode_jpeg(image['original'], image['path'], quality)
+
+    omitted = []
+    files = sorted([attachment for attachment in packaged if attachment['disposition'] == 'attachment'],
+                   key=lambda attachment: os.path.getsize(attachment['path']))
+    while files and encoded_size(packaged) > budget:
+        attachment = files.pop()
+        packaged.remove(attachment)
+        omitted.append(attachment)
+
+    rows = []
+    for attachment in packaged + omitted:
+        original_size = os.path.getsize(attachment['original'])
+        if attachment in omitted:
+            sent = 'not sent, too large'
+        else:
+            sent = '%s, %s' % (os.path.basename(attachment['path']), format_size(os.path.getsize(attachment['path'])))
+        rows.append('<tr><td>%s</td><td align="right">%s</td><td>%s</td></tr>' %
+            (os.path.basename(attachment['original']), format_size(original_size), sent))
+    report = ('<table cellspacing="2" cellpadding="2" border="0"><tr><th align="left">File</th>'
+              '<th align="right">Size</th><th align="left">Sent as</th></tr>%s</table>' % (''.join(rows),))
+
+    return ([{'path': attachment['path'], 'disposition': attachment['disposition']} for attachment in packaged], report)
+
+
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024 or unit == 'MB':
+            return '%d %s' % (size, unit) if unit == 'bytes' else '%.1f %s' % (size, unit)
+        size /= 1024.0
@@ -0,0 +1,410 @@
+"""Read RINEX 3 observation files.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import calendar
+import itertools
+import mmap
+import os
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from my_constants import GAP_FACTOR, INDEX_CHUNK_SIZE, MIN_RATE_RUN
+
+
+class ObsSummary(object):
+    """Summary of a RINEX observation file, from scan_obs_file.
+
+    Attributes:
+      num_epochs: Number of observation epochs.
+      start_time, end_time: Times of the first and last epochs, in seconds since 1970.
+      intervals: Counter of the time between epochs, rounded to the millisecond.
+      sample_interval: Median time between epochs, or None if there are fewer than two.
+      gaps: List of (start, end) times between which an epoch is missing.
+      third_col: True if the first observation after line 100 has a third column,
+        which is the case for u-blox M8T receivers.
+      satellites: Set of satellite ids, such as 'G01'.
+      constellations: Counter of the number of satellites of each system, such as 'G'.
+    """
+    def __init__(self):
+        self.num_epochs = 0
+        self.start_time = None
+        self.end_time = None
+        self.intervals = Counter()
+        self.sample_interval = None
+        self.gaps = []
+        self.third_col = None
+        self.satellites = set()
+        self.constellations = Counter()
+
+
+def parse_epoch_time(line):
+    # epoch lines look like "> 2017 03 15 12 34 56.2000000  0 18"
+    fields = line[1:].split()
+    seconds = calendar.timegm((int(fields[0]), int(fields[1]), int(fields[2]),
+                               int(fields[3]), int(fields[4]), 0))
+    return seconds + float(fields[5])
+
+
+def median_of_counts(counts):
+    total = sum(counts.values())
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen * 2 >= total:
+            return value
+
+
+def epoch_times(filename):
+    # times of the observation epochs of a file, leaving out event records
+    in_header = True
+    skip_records = 0
+    with open(filename) as obs_file:
+        for line in obs_file:
+            if in_header:
+                if line[60:73] == 'END OF HEADER':
+                    in_header = False
+            elif skip_records:
+                skip_records -= 1
+            elif line[0] == '>':
+                flag = int(line[31:32] or 0)
+                if flag > 1:
+                    skip_records = int(line[32:35] or 0)
+                else:
+                    yield parse_epoch_time(line)
+
+
+def quicklook_epochs(rover_file, base_file, interval):
+    """Choose the epochs of a rover and a base observation file to keep when
+    thinning them to one epoch in each interval seconds, counted from the
+    start of 1970.
+
+    In each interval, both files keep the first epoch they have in common,
+    so that the thinned files stay aligned for differencing.  In intervals
+    without one, such as where the receivers sample at different offsets
+    from the whole second, each file keeps its own first epoch.  The epoch
+    times are read a file at a time in step, so memory use only grows with
+    the number of epochs kept.
+
+    Returns:
+      Tuple of the sets of times, in milliseconds since 1970, of the epochs
+      to keep of the rover and of the base.
+    """
+    step = int(round(interval * 1000))
+    def buckets(filename):
+        # (bucket, times in milliseconds) of each interval with epochs, in order
+        times = (int(round(time * 1000)) for time in epoch_times(filename))
+        return ((bucket, list(group)) for bucket, group in itertools.groupby(times, lambda t: t // step))
+    rover_keep = set()
+    base_keep = set()
+    rover_buckets = buckets(rover_file)
+    base_buckets = buckets(base_file)
+    rover = next(rover_buckets, None)
+    base = next(base_buckets, None)
+    while rover or base:
+        if base is None or (rover and rover[0] < base[0]):
+            rover_keep.add(rover[1][0])
+            rover = next(rover_buckets, None)
+        elif rover is None or base[0] < rover[0]:
+            base_keep.add(base[1][0])
+            base = next(base_buckets, None)
+        else:
+            base_times = set(base[1])
+            common = next((t for t in rover[1] if t in base_times), None)
+            rover_keep.add(rover[1][0] if common is None else common)
+            base_keep.add(base[1][0] if common is None else common)
+            rover = next(rover_buckets, None)
+            base = next(base_buckets, None)
+    return (rover_keep, base_keep)
+
+
+def decimate_obs_file(in_file, out_file, interval, keep):
+    """Copy an observation file a line at a time, keeping only the epochs
+    chosen by quicklook_epochs.
+
+    Special records following an event flag are always kept, and the
+    INTERVAL header line is updated.
+
+    Args:
+      interval: Seconds between the epochs kept, for the header.
+      keep: Set of the times, in milliseconds since 1970, of the epochs to keep.
+
+    Returns:
+      Tuple of the numbers of epochs read and kept.
+    """
+    num_read = 0
+    num_kept = 0
+    in_header = True
+    skip_records = 0
+    keep_epoch = True
+    with open(in_file) as src, open(out_file, 'w') as dst:
+        for line in src:
+            if in_header:
+                if line[60:].strip() == 'INTERVAL':
+                    line = '%10.3f%50s%-20s\n' % (interval, '', 'INTERVAL')
+                elif line[60:73] == 'END OF HEADER':
+                    in_header = False
+                dst.write(line)
+                continue
+            if skip_records:
+                skip_records -= 1
+                dst.write(line)
+                continue
+            if line[0] == '>':
+                flag = int(line[31:32] or 0)
+                if flag > 1:
+                    skip_records = int(line[32:35] or 0)
+                    dst.write(line)
+                    continue
+                num_read += 1
+                # to the millisecond, as the times are written
+                keep_epoch = int(round(parse_epoch_time(line) * 1000)) in keep
+                num_kept += keep_epoch
+            if keep_epoch:
+                dst.write(line)
+    return (num_read, num_kept)
+
+
+def scan_obs_file(filename):
+    """Read an observation file once, line by line, and summarize it.
+
+    Only the candidate gaps (intervals longer than GAP_FACTOR times the
+    shortest so far, or one and a half times if GAP_FACTOR is larger) are
+    remembered individually, so memory use does not grow with the length of
+    the file for regularly sampled data.  Those longer than GAP_FACTOR times
+    the median interval are the gaps.  If an interval passed over while the
+    shortest was still longer, as when the rate goes up part way through,
+    turns out to be longer than that as well, the file is read a second
+    time for the gaps, so that they are the same as EpochIndex.gaps finds.
+
+    Returns:
+      ObsSummary
+    """
+    summary = ObsSummary()
+    in_header = True
+    skip_records = 0
+    prev_time = None
+    min_interval = None
+    candidate_gaps = []
+    candidate_factor = min(1.5, GAP_FACTOR)
+    # longest interval which was not a candidate
+    max_passed = 0
+
+    with open(filename) as obs_file:
+        for line_num, line in enumerate(obs_file):
+            if in_header:
+                if line[60:73] == 'END OF HEADER':
+                    in_header = False
+                continue
+            if skip_records:
+                # special records following an event flag
+                skip_records -= 1
+                continue
+            if line[0] == '>':
+                flag = int(line[31:32] or 0)
+                if flag > 1:
+                    skip_records = int(line[32:35] or 0)
+                    continue
+                time = parse_epoch_time(line)
+                summary.num_epochs += 1
+                if prev_time is None:
+                    summary.start_time = time
+                else:
+                    interval = round(time - prev_time, 3)
+                    summary.intervals[interval] += 1
+                    if interval > 0 and (min_interval is None or interval < min_interval):
+                        min_interval = interval
+                    if min_interval and interval > candidate_factor * min_interval:
+                        candidate_gaps.append((prev_time, time))
+                    else:
+                        max_passed = max(max_passed, time - prev_time)
+                prev_time = time
+                continue
+            if len(line.strip()) < 3:
+                continue
+            summary.satellites.add(line[0:3].replace(' ', '0'))
+            # look at the first data line after line 100, well clear of the header
+            if summary.third_col is None and line_num >= 100 and len(line.strip()) >= 19:
+                summary.third_col = line[18] != ' '
+
+    summary.end_time = prev_time
+    summary.sample_interval = median_of_counts(summary.intervals)
+    if summary.sample_interval:
+        gap_length = GAP_FACTOR * summary.sample_interval
+        if max_passed > gap_length:
+            starts, ends = itertools.tee(epoch_times(filename))
+            next(ends, None)
+            candidate_gaps = zip(starts, ends)
+        summary.gaps = [(start, end) for start, end in candidate_gaps if end - start > gap_length]
+    summary.constellations = Counter(sat[0] for sat in summary.satellites)
+    return summary
+
+
+class EpochIndex(object):
+    """Byte offsets and times of the epochs of a memory-mapped observation
+    file, held in NumPy arrays so that timing statistics are vectorized and
+    any time window of the file can be read without rescanning it.
+
+    Requires NumPy.  Use as a context manager, or call close() when done.
+
+    Attributes:
+      offsets: Byte offset of each epoch line.
+      times: Time of each epoch, in seconds since 1970.
+    """
+    def __init__(self, filename):
+        if np is None:
+            raise ImportError('EpochIndex requires numpy.')
+        with open(filename, 'rb') as f:
+            # an empty file cannot be mapped, and has no epochs anyway
+            if os.fstat(f.fileno()).st_size:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.mm = b''
+        buf = np.frombuffer(self.mm, dtype=np.uint8)
+        self.size = len(buf)
+
+        # epoch lines are the ones starting with '>' after the header
+        header_end = self.mm.find(b'END OF HEADER')
+        header_end = self.mm.find(b'\n', header_end) + 1 if header_end != -1 else 0
+        offsets = []
+        for start in range(max(header_end, 1), self.size, INDEX_CHUNK_SIZE):
+            chunk = buf[start-1:start+INDEX_CHUNK_SIZE]
+            offsets.append(np.flatnonzero((chunk[:-1] == ord('\n')) & (chunk[1:] == ord('>'))) + start)
+        offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+        if header_end == 0 and self.size and buf[0] == ord('>'):
+            offsets = np.concatenate([[0], offsets])
+
+        # parse the fixed columns of "> 2017 03 15 12 34 56.2000000  0 18" all at once
+        cols = buf[np.minimum(offsets[:, None] + np.arange(35), self.size - 1)].astype(np.int64) - ord('0')
+        cols[(cols < 0) | (cols > 9)] = 0
+        def field(start, end):
+            value = np.zeros(len(offsets), dtype=np.int64)
+            for col in range(start, end):
+                value = value * 10 + cols[:, col]
+            return value
+        months = (field(2, 6) - 1970) * 12 + field(7, 9) - 1
+        days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + field(10, 12) - 1
+        times = (days * 86400 + field(13, 15) * 3600 + field(16, 18) * 60 + field(18, 21)
+                 + field(22, 29) / 1e7)
+
+        # leave out event records, which are not observations
+        is_obs = field(31, 32) <= 1
+        self.offsets = offsets[is_obs]
+        self.times = times[is_obs]
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def intervals(self):
+        """Time between consecutive epochs, rounded to the millisecond."""
+        return np.round(np.diff(self.times), 3)
+
+    def interval_stats(self):
+        """Returns a dictionary with the median, min, max, mean and 95th
+        percentile of the intervals, and 'histogram', a dictionary mapping
+        each interval to the number of times it occurs.
+        """
+        intervals = self.intervals()
+        if len(intervals) == 0:
+            return None
+        values, counts = np.unique(intervals, return_counts=True)
+        return {
+            'median': float(np.median(intervals)),
+            'min': float(intervals.min()),
+            'max': float(intervals.max()),
+            'mean': float(intervals.mean()),
+            'p95': float(np.percentile(intervals, 95)),
+            'histogram': dict(zip(values.tolist(), counts.tolist())),
+        }
+
+    def gaps(self, factor=GAP_FACTOR):
+        """Array of (start, end) times between which epochs are missing.
+
+        An interval is a gap if it is longer than factor times the median
+        interval, as in scan_obs_file.
+        """
+        intervals = self.intervals()
+        if len(intervals) == 0:
+            return np.zeros((0, 2))
+        is_gap = intervals > factor * np.median(intervals)
+        return np.column_stack([self.times[:-1][is_gap], self.times[1:][is_gap]])
+
+    def rate_changes(self, min_run=MIN_RATE_RUN):
+        """List of (time, old interval, new interval) at which the sample
+        interval changes and then stays the same for at least min_run epochs.
+        """
+        intervals = self.intervals()
+        if len(intervals) == 0:
+            return []
+        # run length encode the intervals, keeping only the long runs
+        starts = np.flatnonzero(np.r_[True, intervals[1:] != intervals[:-1]])
+        lengths = np.diff(np.r_[starts, len(intervals)])
+        starts = starts[lengths >= min_run]
+        rates = intervals[starts]
+        changed = np.flatnonzero(rates[1:] != rates[:-1]) + 1
+        return [(float(self.times[starts[i]]), float(rates[i-1]), float(rates[i])) for i in changed]
+
+    def overlap(self, other):
+        """Returns (start, end, number of common epochs) of the time span
+        covered by both this file and another, or None if there is none.
+        """
+        if len(self.times) == 0 or len(other.times) == 0:
+            return None
+        start = max(self.times[0], other.times[0])
+        end = min(self.times[-1], other.times[-1])
+        if start > end:
+            return None
+        common = np.intersect1d(np.round(self.times * 1000).astype(np.int64),
+                                np.round(other.times * 1000).astype(np.int64), assume_unique=True)
+        return (float(start), float(end), len(common))
+
+    def satellite_obs(self):
+        """Satellite observation records, found and parsed without looping over lines.
+
+        Returns:
+          Tuple of arrays, with one entry per record: the index of its epoch,
+          the satellite (system letter * 100 + prn, e.g. ord('G') * 100 + 1),
+          and True if the first observation's loss of lock indicator is set.
+        """
+        buf = np.frombuffer(self.mm, dtype=np.uint8)
+        if len(self.offsets) == 0:
+            return (np.zeros(0, dtype=np.int64),) * 2 + (np.zeros(0, dtype=bool),)
+        starts = np.flatnonzero(buf[self.offsets[0]:-1] == ord('\n')) + self.offsets[0] + 1
+        def col(n):
+            return buf[np.minimum(starts + n, self.size - 1)].astype(np.int16)
+        system, tens, ones, lli = col(0), col(1) - ord('0'), col(2) - ord('0'), col(17) - ord('0')
+        # records start with a system letter and a two digit prn, e.g. "G01"
+        is_sat = ((system >= ord('A')) & (system <= ord('Z')) &
+                  (tens >= 0) & (tens <= 9) & (ones >= 0) & (ones <= 9))
+        epochs = np.searchsorted(self.offsets, starts[is_sat]) - 1
+        sats = system[is_sat].astype(np.int64) * 100 + tens[is_sat] * 10 + ones[is_sat]
+        lli = lli[is_sat]
+        slips = (lli >= 0) & (lli <= 9) & (lli % 2 == 1)
+        return (epochs, sats, slips)
+
+    def read_window(self, start, end):
+        """Returns the text of the epochs from time start up to, but not including, time end."""
+        first, last = np.searchsorted(self.times, [start, end])
+        if first >= len(self.times):
+            return ''
+        # the text runs up to the next observation epoch, so event records inside the window are kept
+        begin = int(self.offsets[first])
+        if last < len(self.times):
+            stop = int(self.offsets[last])
+        else:
+            stop = self.size
+        return self.mm[begin:stop].decode('ascii', 'replace')
@@ -0,0 +1,177 @@
+"""Decide which waiting message to process next.
+
+Short jobs go first, so that a quick submission is not stuck behind a
+stack of long ones, but each sender's share of the workers is also
+weighed, so that one sender cannot crowd out the others, and the longer a
+job has waited the sooner it runs.  No job waits more than
+SCHEDULE_MAX_WAIT seconds once a worker is free, except for senders over
+their rate limit.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import threading
+import time
+from collections import Counter
+from email.utils import parseaddr
+
+from metrics_utils import metrics
+from my_constants import (SCHEDULE_JOB_OVERHEAD, SCHEDULE_ZIP_FACTOR, SCHEDULE_AGING_RATE, SCHEDULE_MAX_WAIT,
+    SCHEDULE_FAIR_HALF_LIFE, SCHEDULE_SENDER_PER_HOUR, SCHEDULE_SENDER_BURST)
+
+
+def attachment_parts(part):
+    # attachments may be nested in multipart parts
+    if part.get('filename'):
+        yield part
+    for child in part.get('parts', []):
+        for attachment in attachment_parts(child):
+            yield attachment
+
+
+def job_cost(contents):
+    """Estimate of the work of a message, in bytes, from the sizes of its
+    attachments given in the message itself, before they are downloaded.
+
+    Zip files count SCHEDULE_ZIP_FACTOR times their size, and every job
+    costs SCHEDULE_JOB_OVERHEAD bytes more for the work that does not
+    depend on the size of the data.
+    """
+    cost = SCHEDULE_JOB_OVERHEAD
+    for part in attachment_parts(contents.get('payload', {})):
+        size = part.get('body', {}).get('size', 0)
+        if part['filename'].lower().endswith('.zip'):
+            size *= SCHEDULE_ZIP_FACTOR
+        cost += size
+    return cost
+
+
+def sender_of(contents):
+    # lower case address from the From header, or '' if there is none
+    for header in contents.get('payload', {}).get('headers', []):
+        if header['name'] == 'From':
+            return parseaddr(header['value'])[1].lower()
+    return ''
+
+
+class RateLimit(object):
+    """Token bucket allowing burst jobs at once and per_hour jobs an hour after that."""
+    def __init__(self, per_hour, burst, now):
+        self.per_hour = per_hour
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_hour / 3600.0)
+        self.updated = now
+
+    def ready(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class Scheduler(object):
+    """Queue of fetched messages waiting for a worker.  Thread-safe.
+
+    The next job is the one with the lowest
+        cost + share of sender - SCHEDULE_AGING_RATE * seconds waited
+    where the share of a sender is the cost of the jobs of that sender
+    started recently, halving every SCHEDULE_FAIR_HALF_LIFE seconds.  Jobs
+    which have waited SCHEDULE_MAX_WAIT seconds or more go first, oldest
+    first.  Each sender may start SCHEDULE_SENDER_BURST jobs at once and
+    SCHEDULE_SENDER_PER_HOUR an hour after that; the rest wait their turn.
+
+    Args:
+      clock: Function returning the time in seconds.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # msg_id -> (contents, sender, cost, time queued)
+        self.waiting = {}
+        # sender -> (share, time updated)
+        self.shares = {}
+        self.limits = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.waiting)
+
+    def __contains__(self, msg_id):
+        with self.lock:
+            return msg_id in self.waiting
+
+    def add(self, contents):
+        with self.lock:
+            if contents['id'] not in self.waiting:
+                self.waiting[contents['id']] = (contents, sender_of(contents), job_cost(contents), self.clock())
+
+    def share(self, sender, now):
+        share, updated = self.shares.get(sender, (0.0, now))
+        return share * 0.5 ** ((now - updated) / SCHEDULE_FAIR_HALF_LIFE)
+
+    def rate_limit(self, sender, now):
+        if sender not in self.limits:
+            self.limits[sender] = RateLimit(SCHEDULE_SENDER_PER_HOUR, SCHEDULE_SENDER_BURST, now)
+        return self.limits[sender]
+
+    def ready(self, now):
+        # (msg_id, sender, cost, time queued) of the jobs of senders within their rate limit
+        return [(msg_id, sender, cost, queued) for msg_id, (_, sender, cost, queued) in self.waiting.items()
+                if not SCHEDULE_SENDER_PER_HOUR or self.rate_limit(sender, now).ready(now)]
+
+    def num_ready(self):
+        """Number of waiting jobs which could start now, leaving out those of
+        senders over their rate limit."""
+        with self.lock:
+            return len(self.ready(self.clock()))
+
+    def over_limit(self, messages):
+        """Ids of the messages, fetched with their headers only, which could
+        not start now because their senders have no rate limit to spare,
+        counting the jobs of each sender already waiting and the messages
+        before them."""
+        if not SCHEDULE_SENDER_PER_HOUR:
+            return []
+        with self.lock:
+            now = self.clock()
+            queued = Counter(sender for _, sender, _, _ in self.waiting.values())
+            held = []
+            for contents in messages:
+                sender = sender_of(contents)
+                limit = self.rate_limit(sender, now)
+                limit.refill(now)
+                if queued[sender] + 1 > limit.tokens:
+                    held.append(contents['id'])
+                else:
+                    queued[sender] += 1
+            return held
+
+    def pop(self):
+        """Returns the contents of the next message to process, or None if
+        nothing is waiting or every waiting sender is over their rate limit."""
+        with self.lock:
+            now = self.clock()
+            ready = self.ready(now)
+            if not ready:
+                return None
+            overdue = [job for job in ready if now - job[3] >= SCHEDULE_MAX_WAIT]
+            if overdue:
+                msg_id, sender, cost, queued = min(overdue, key=lambda job: job[3])
+            else:
+                shares = dict((sender, self.share(sender, now)) for _, sender, _, _ in ready)
+                msg_id, sender, cost, queued = min(ready, key=lambda job:
+                    (job[2] + shares[job[1]] - SCHEDULE_AGING_RATE * (now - job[3]), job[3]))
+            self.shares[sender] = (self.share(sender, now) + cost, now)
+            if SCHEDULE_SENDER_PER_HOUR:
+                self.rate_limit(sender, now).take(now)
+            contents = self.waiting.pop(msg_id)[0]
+        metrics.observe('queue_wait_seconds', now - queued)
+        return contents
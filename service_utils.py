@@ -0,0 +1,92 @@
+"""Hand out authorized Gmail services and http connections to worker threads.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import datetime
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import httplib2
+from apiclient import discovery
+
+from my_constants import DISCOVERY_CACHE_FILE, DISCOVERY_MAX_AGE, TOKEN_REFRESH_MARGIN
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/gmail/v1/rest'
+
+
+class ServiceProvider(object):
+    """Builds Gmail services from one set of credentials and a locally cached
+    discovery document, so that neither is fetched again for every reply.
+
+    httplib2 connections are not thread-safe, so each thread gets its own
+    service, which it keeps (along with its open connection) for as long as
+    the thread lives.  Connections for short jobs, such as attachment
+    downloads, are borrowed from a pool and returned still open.
+
+    Args:
+      get_credentials: Function returning the stored credentials.
+    """
+    def __init__(self, get_credentials):
+        self.get_credentials = get_credentials
+        self.credentials = None
+        self.document = None
+        self.lock = threading.Lock()
+        self.thread_data = threading.local()
+        self.idle_http = queue.LifoQueue()
+
+    def authorize(self):
+        """Returns the credentials, refreshing the access token if it expires soon."""
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = self.get_credentials()
+            expiry = getattr(self.credentials, 'token_expiry', None)
+            if self.credentials.access_token_expired or (expiry and
+                    expiry - datetime.datetime.utcnow() < datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN)):
+                self.credentials.refresh(httplib2.Http())
+            return self.credentials
+
+    def new_http(self):
+        return self.authorize().authorize(httplib2.Http())
+
+    def get_document(self):
+        with self.lock:
+            if self.document is None:
+                if (os.path.exists(DISCOVERY_CACHE_FILE) and
+                        time.time() - os.path.getmtime(DISCOVERY_CACHE_FILE) < DISCOVERY_MAX_AGE):
+                    with open(DISCOVERY_CACHE_FILE) as f:
+                        self.document = f.read()
+                else:
+                    response, content = httplib2.Http().request(DISCOVERY_URL)
+                    if response.status != 200:
+                        raise Exception('Could not fetch discovery document: HTTP %d.' % (response.status,))
+                    self.document = content.decode('UTF-8')
+                    with open(DISCOVERY_CACHE_FILE, 'w') as f:
+                        f.write(self.document)
+            return self.document
+
+    def service(self):
+        """Returns the service belonging to the calling thread."""
+        # refresh the token ahead of time rather than paying for a failed request
+        self.authorize()
+        if not hasattr(self.thread_data, 'service'):
+            self.thread_data.service = discovery.build_from_document(self.get_document(), http=self.new_http())
+        return self.thread_data.service
+
+    @contextmanager
+    def borrow_http(self):
+        """Context manager lending out an authorized http object for the calling thread to use."""
+        self.authorize()
+        try:
+            http = self.idle_http.get_nowait()
+        except queue.Empty:
+            http = self.new_http()
+        try:
+            yield http
+        finally:
+            self.idle_http.put(http)
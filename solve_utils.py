@@ -0,0 +1,173 @@
+"""Solve long observation files in overlapping time slices, in parallel.
+
+Each slice starts SLICE_OVERLAP seconds before the part of the solution
+it contributes, so that the filter has converged (and, ideally, fixed) by
+the time its epochs are kept.  Run directly to compare a merged solution
+with a single pass over the same data:
+
+    python solve_utils.py out_demo5.pos out_demo5_single.pos
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import calendar
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from my_constants import SLICE_SECONDS, SLICE_OVERLAP, SLICE_WORKERS
+
+# gps time started at 1980/1/6
+GPS_EPOCH = calendar.timegm((1980, 1, 6, 0, 0, 0))
+
+
+def time_slices(start, end, chunk=SLICE_SECONDS, overlap=SLICE_OVERLAP):
+    """Split the span from start to end into slices.
+
+    Returns:
+      List of (solve_start, keep_start, keep_end) times: each slice is
+      solved from solve_start to keep_end, and its epochs from keep_start
+      up to, but not including, keep_end are kept.  The last slice keeps
+      its last epoch too.
+    """
+    slices = []
+    keep_start = start
+    while keep_start < end:
+        keep_end = min(keep_start + chunk, end)
+        # a short tail would barely converge, so fold it into the slice before
+        if end - keep_end < chunk / 4.0:
+            keep_end = end
+        slices.append((max(start, keep_start - overlap), keep_start, keep_end))
+        keep_start = keep_end
+    return slices
+
+
+def slice_overwrites(template):
+    """Overwrites for the config of the slice runs of a ConfigTemplate, so
+    that merge_pos_files can read their solutions: times in GPST, which the
+    slices are cut in since the observations are, as y/m/d h:m:s, and
+    positions as llh rather than nmea.  The merged solution is written
+    the same way, whatever the template says.
+    """
+    overwrites = {'out-timesys': 'gpst', 'out-timeform': 'hms'}
+    option = template.options.get('out-solformat')
+    if option and option.value in ('nmea', '3'):
+        overwrites['out-solformat'] = 'llh'
+    return overwrites
+
+
+def pos_line_time(line):
+    # solution lines start with "2017/03/15 12:00:00.000" or "1946 302400.000"
+    fields = line.split()
+    if '/' in fields[0]:
+        date = [int(v) for v in fields[0].split('/')]
+        clock = fields[1].split(':')
+        return calendar.timegm((date[0], date[1], date[2], int(clock[0]), int(clock[1]), 0)) + float(clock[2])
+    return GPS_EPOCH + int(fields[0]) * 604800 + float(fields[1])
+
+
+def read_pos_epochs(filename):
+    """Returns the header lines and a list of (time, quality, line) for each epoch of a solution file."""
+    header = []
+    epochs = []
+    with open(filename) as pos_file:
+        for line in pos_file:
+            if line.startswith('%'):
+                header.append(line)
+            elif line.strip():
+                epochs.append((pos_line_time(line), int(line.split()[5]), line))
+    return (header, epochs)
+
+
+def merge_pos_files(pos_files, slices, out_file):
+    """Merge the solutions of each slice, dropping the epochs of the overlaps.
+
+    The header is taken from the first slice.
+    """
+    with open(out_file, 'w') as out:
+        for i, (pos_file, (solve_start, keep_start, keep_end)) in enumerate(zip(pos_files, slices)):
+            last = i == len(slices) - 1
+            # time tags are rounded to the millisecond in the solution files
+            keep_start -= 0.0005
+            keep_end += 0.0005 if last else -0.0005
+            with open(pos_file) as pos:
+                for line in pos:
+                    if line.startswith('%'):
+                        if i == 0:
+                            out.write(line)
+                    elif line.strip() and keep_start <= pos_line_time(line) < keep_end:
+                        out.write(line)
+
+
+def solve_sliced(solve, start, end, sln_file, max_workers=SLICE_WORKERS,
+                 chunk=SLICE_SECONDS, overlap=SLICE_OVERLAP):
+    """Solve the span from start to end in slices, in parallel, and merge them into sln_file.
+
+    Args:
+      solve: Function run as solve(slice_sln_file, solve_start, solve_end).
+      start, end: Times of the first and last rover epochs.
+      sln_file: Merged solution file.  The solution of each slice is
+        written to the slices directory next to it.
+    """
+    slices = time_slices(start, end, chunk, overlap)
+    slice_dir = os.path.join(os.path.dirname(sln_file), 'slices')
+    if not os.path.isdir(slice_dir):
+        os.makedirs(slice_dir)
+    name, ext = os.path.splitext(os.path.basename(sln_file))
+    pos_files = [os.path.join(slice_dir, '%s_%03d%s' % (name, i, ext)) for i in range(len(slices))]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(solve, pos_file, solve_start, keep_end)
+                   for pos_file, (solve_start, _, keep_end) in zip(pos_files, slices)]
+        for future in futures:
+            future.result()
+    merge_pos_files(pos_files, slices, sln_file)
+    return slices
+
+
+def solution_stats(epochs):
+    num_fix = sum(1 for _, q, _ in epochs if q == 1)
+    first_fix = next((t for t, q, _ in epochs if q == 1), None)
+    return {
+        'epochs': len(epochs),
+        'fix_ratio': 100.0 * num_fix / max(len(epochs), 1),
+        'first_fix': first_fix - epochs[0][0] if first_fix is not None else None,
+    }
+
+
+def compare_solutions(merged_file, single_file):
+    """Compare a merged solution with a single pass over the same data.
+
+    Returns:
+      Dictionary of the stats of each ('merged' and 'single', each with
+      'epochs', 'fix_ratio' in percent and 'first_fix' in seconds from the
+      first epoch), the number of epochs in both, and 'agreement', the
+      percentage of those with the same solution quality.
+    """
+    merged = read_pos_epochs(merged_file)[1]
+    single = read_pos_epochs(single_file)[1]
+    single_q = dict((round(t, 3), q) for t, q, _ in single)
+    common = [(q, single_q[round(t, 3)]) for t, q, _ in merged if round(t, 3) in single_q]
+    return {
+        'merged': solution_stats(merged),
+        'single': solution_stats(single),
+        'common': len(common),
+        'agreement': 100.0 * sum(1 for a, b in common if a == b) / max(len(common), 1),
+    }
+
+
+def format_comparison(comparison):
+    """One line summary of compare_solutions."""
+    def first_fix(stats):
+        return '%.0f s' % (stats['first_fix'],) if stats['first_fix'] is not None else 'none'
+    return ('sliced: %d epochs, %.1f%% fixed, first fix %s; single pass: %d epochs, %.1f%% fixed, '
+            'first fix %s; same quality at %.1f%% of %d common epochs' %
+            (comparison['merged']['epochs'], comparison['merged']['fix_ratio'], first_fix(comparison['merged']),
+             comparison['single']['epochs'], comparison['single']['fix_ratio'], first_fix(comparison['single']),
+             comparison['agreement'], comparison['common']))
+
+
+if __name__ == '__main__':
+    import sys
+
+    print(format_comparison(compare_solutions(sys.argv[1], sys.argv[2])))
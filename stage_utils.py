@@ -0,0 +1,87 @@
+"""Run the steps of a job as a dependency graph of stages.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage(object):
+    """One step of a job.
+
+    Args:
+      name: Name used in error messages.
+      func: Callable run with the values of the inputs as positional arguments.
+        It returns nothing if there are no outputs, the value of the output if
+        there is one, or a tuple of values if there are several.
+      inputs: Names of the values the stage needs before it can run.
+      outputs: Names of the values the stage produces.
+    """
+    def __init__(self, name, func, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def run(self, values):
+        result = self.func(*[values[name] for name in self.inputs])
+        if len(self.outputs) == 0:
+            return {}
+        if len(self.outputs) == 1:
+            return {self.outputs[0]: result}
+        return dict(zip(self.outputs, result))
+
+
+def run_stages(stages, max_workers, values=None, on_done=None):
+    """Run stages in parallel as soon as all of their inputs are available.
+
+    Stages with outputs, all of which are already in values, are skipped.
+
+    Args:
+      stages: List of Stage objects.
+      max_workers: Maximum number of stages run at once.
+      values: Dictionary of values available before any stage runs.
+      on_done: Function called with the dictionary of values so far each
+        time a stage finishes, on the calling thread.
+
+    Returns:
+      Dictionary of all values, including those produced by the stages.
+
+    If a stage raises, no further stages are started, the running ones are
+    allowed to finish and the first exception is re-raised.
+    """
+    values = dict(values or {})
+    pending = [stage for stage in stages
+               if not stage.outputs or not all(name in values for name in stage.outputs)]
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            if not error:
+                for stage in [s for s in pending if all(name in values for name in s.inputs)]:
+                    pending.remove(stage)
+                    inputs = dict((name, values[name]) for name in stage.inputs)
+                    running[pool.submit(stage.run, inputs)] = stage
+            if not running:
+                if error:
+                    break
+                raise ValueError('Stages %s have inputs that no stage produces.' %
+                    (', '.join(stage.name for stage in pending),))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                try:
+                    values.update(future.result())
+                except Exception as e:
+                    error = error or e
+                    continue
+                if on_done:
+                    on_done(values)
+
+    if error:
+        raise error
+    return values
@@ -0,0 +1,98 @@
+"""Solve the same data with several values of config options and compare the solutions.
+
+Alternative values are separated by '|' in the body of the email, for example
+
+    pos2-arthres=3|5|7
+    pos1-elmask=10|15
+
+which is solved with each of the six combinations.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import itertools
+import os
+
+import plot_utils
+from log_utils import DataException
+from solve_utils import read_pos_epochs, solution_stats
+from my_constants import SWEEP_MAX_VARIANTS
+
+SWEEP_SEPARATOR = '|'
+
+
+def split_sweep(overwrites):
+    """Separate the alternative values of swept options.
+
+    Returns:
+      Tuple of the overwrites with the first value of each swept option,
+      and a dictionary mapping each swept option to its list of values.
+    """
+    first = {}
+    swept = {}
+    for name, value in overwrites.items():
+        if SWEEP_SEPARATOR in str(value):
+            swept[name] = [v.strip() for v in str(value).split(SWEEP_SEPARATOR)]
+            first[name] = swept[name][0]
+        else:
+            first[name] = value
+    return (first, swept)
+
+
+def sweep_variants(swept, max_variants=SWEEP_MAX_VARIANTS):
+    """List of dictionaries of values, one for each combination of the swept values.
+
+    The first has the first value of each option.  Empty if nothing is swept.
+    """
+    if not swept:
+        return []
+    names = sorted(swept)
+    num_variants = 1
+    for name in names:
+        num_variants *= len(swept[name])
+    if num_variants > max_variants:
+        raise DataException('The settings in your email make %d combinations, but at most %d can be solved.' %
+            (num_variants, max_variants))
+    return [dict(zip(names, values)) for values in itertools.product(*[swept[name] for name in names])]
+
+
+def summarize_solution(sln_file):
+    """Fix ratio, time to first fix and position spread of a solution.
+
+    Returns:
+      Dictionary with 'epochs', 'fix_ratio' (percent), 'first_fix' (seconds
+      from the first epoch, or None) and 'spread' (standard deviations in
+      meters of the horizontal and vertical positions of the fixed epochs,
+      or all epochs if none are fixed, or None without numpy).
+    """
+    stats = solution_stats(read_pos_epochs(sln_file)[1])
+    stats['spread'] = None
+    if plot_utils.available and stats['epochs']:
+        sol = plot_utils.read_pos_file(sln_file)
+        use = sol['q'] == 1 if stats['fix_ratio'] > 0 else slice(None)
+        e, n, u = sol['e'][use], sol['n'][use], sol['u'][use]
+        stats['spread'] = (float((e.var() + n.var()) ** 0.5), float(u.std()))
+    return stats
+
+
+def sweep_table(variants, sln_files):
+    """Html table comparing the solution of each variant."""
+    names = sorted(variants[0])
+    rows = []
+    for values, sln_file in zip(variants, sln_files):
+        stats = summarize_solution(sln_file)
+        cells = [values[name] for name in names]
+        cells.append('%.1f%%' % (stats['fix_ratio'],))
+        cells.append('%.0f s' % (stats['first_fix'],) if stats['first_fix'] is not None else 'no fix')
+        if stats['spread']:
+            cells.append('%.3f m / %.3f m' % stats['spread'])
+        else:
+            cells.append('-')
+        cells.append(os.path.basename(sln_file))
+        rows.append('<tr>%s</tr>' % (''.join('<td>%s</td>' % (cell,) for cell in cells),))
+    header = ''.join('<th>%s</th>' % (name,) for name in names + ['fix ratio', 'first fix',
+                                                                  'spread (hor / ver)', 'solution'])
+    return ('<table cellspacing="2" cellpadding="4" border="1"><tr>%s</tr>%s</table>' %
+            (header, ''.join(rows)))
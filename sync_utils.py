@@ -0,0 +1,116 @@
+"""Keep track of new unread messages without listing the whole mailbox each time.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import time
+
+from apiclient import errors
+
+from my_constants import (INCREMENTAL_SYNC, FULL_SYNC_INTERVAL, POLL_INTERVAL_MIN,
+    POLL_INTERVAL_MAX, UNREAD_QUERY)
+
+
+class MailboxSync(object):
+    """Find unread messages, using the mailbox history between full listings.
+
+    A full listing of unread messages is done on the first call, whenever the
+    stored history id has expired, and every FULL_SYNC_INTERVAL seconds as a
+    safety net.  In between, only the messages added since the last history
+    id are asked for.
+
+    Args:
+      service: Authorized Gmail API service instance.
+      user_id: User's email address. The special value "me"
+      can be used to indicate the authenticated user.
+      incremental: Whether to use the history at all, otherwise every
+        call does a full listing.
+      query: Gmail search query of the full listings.  The history cannot be
+        searched, so messages it returns may not match the query.
+    """
+    def __init__(self, service, user_id='me', incremental=INCREMENTAL_SYNC, query=UNREAD_QUERY):
+        self.service = service
+        self.user_id = user_id
+        self.incremental = incremental
+        self.query = query
+        self.history_id = None
+        self.last_full_sync = 0
+        self.deferred = {}
+
+    def get_unread(self):
+        """Returns a list of message dictionaries with 'id' and 'threadId' keys."""
+        if (not self.incremental or self.history_id is None
+                or time.time() - self.last_full_sync > FULL_SYNC_INTERVAL):
+            messages = self.full_sync()
+        else:
+            try:
+                messages = self.history_sync()
+            except errors.HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # history id is too old, so start over
+                print('History id %s has expired, doing a full sync.' % (self.history_id,))
+                messages = self.full_sync()
+
+        # add in any messages we were asked to look at again
+        ids = set(message['id'] for message in messages)
+        messages += [message for msg_id, message in self.deferred.items() if msg_id not in ids]
+        self.deferred = {}
+        return messages
+
+    def defer(self, message):
+        """Return message from the next call to get_unread, e.g. after failing to fetch it."""
+        self.deferred[message['id']] = message
+
+    def full_sync(self):
+        # get the history id first so that nothing added during the listing is missed
+        if self.incremental:
+            profile = self.service.users().getProfile(userId=self.user_id).execute()
+            self.history_id = profile['historyId']
+        self.last_full_sync = time.time()
+
+        messages = []
+        page_token = None
+        while True:
+            response = self.service.users().messages().list(userId=self.user_id, maxResults=500,
+                q=self.query, pageToken=page_token).execute()
+            messages += response.get('messages', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return messages
+
+    def history_sync(self):
+        messages = []
+        page_token = None
+        while True:
+            response = self.service.users().history().list(userId=self.user_id,
+                startHistoryId=self.history_id, historyTypes=['messageAdded'],
+                pageToken=page_token).execute()
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    if 'UNREAD' in message.get('labelIds', []):
+                        messages.append({'id': message['id'], 'threadId': message['threadId']})
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                self.history_id = response['historyId']
+                return messages
+
+
+class PollInterval(object):
+    """Time to sleep between polls, which drops to POLL_INTERVAL_MIN as soon
+    as there is traffic and doubles after each idle poll up to POLL_INTERVAL_MAX.
+    """
+    def __init__(self, minimum=POLL_INTERVAL_MIN, maximum=POLL_INTERVAL_MAX):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.seconds = minimum
+
+    def update(self, busy):
+        if busy:
+            self.seconds = self.minimum
+        else:
+            self.seconds = min(self.seconds * 2, self.maximum)
+        return self.seconds
@@ -0,0 +1,170 @@
+"""Synthetic RINEX 3.03 files and stand-ins for the RTKLIB executables, for benchmarks.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import calendar
+import os
+import random
+import stat
+import sys
+import time
+
+SYSTEMS = 'GREC'
+OBS_TYPES = ['C1C', 'L1C', 'D1C', 'S1C']
+
+
+def header_line(text, label):
+    return '%-60s%-20s\n' % (text, label)
+
+
+def epoch_line(seconds, num_sats, flag=0):
+    t = time.gmtime(int(seconds))
+    return '> %4d %02d %02d %02d %02d%11.7f  %d%3d\n' % (t.tm_year, t.tm_mon, t.tm_mday,
+        t.tm_hour, t.tm_min, t.tm_sec + seconds % 1, flag, num_sats)
+
+
+def write_obs_file(filename, duration=3600, interval=1.0, num_systems=2, sats_per_system=8,
+                   start=(2017, 3, 15, 12, 0, 0), marker='ROVER', slip_rate=0.001, seed=0):
+    """Write a RINEX 3.03 observation file a line at a time.
+
+    Args:
+      duration: Seconds of observations.
+      interval: Seconds between epochs.
+      num_systems: Number of constellations, taken in the order of SYSTEMS.
+      sats_per_system: Number of satellites tracked in each constellation.
+      start: Time of the first epoch, as (year, month, day, hour, minute, second).
+      marker: Marker name written in the header.
+      slip_rate: Chance of each observation having its loss of lock indicator set.
+      seed: Seed for the random observation values and slips.
+    """
+    rand = random.Random(seed)
+    systems = SYSTEMS[:num_systems]
+    sats = ['%s%02d' % (system, prn) for system in systems for prn in range(1, sats_per_system + 1)]
+    ranges = dict((sat, rand.uniform(2.0e7, 2.6e7)) for sat in sats)
+    rates = dict((sat, rand.uniform(-800.0, 800.0)) for sat in sats)
+    t0 = calendar.timegm(start)
+
+    with open(filename, 'w') as obs_file:
+        obs_file.write(header_line('     3.03           OBSERVATION DATA    M', 'RINEX VERSION / TYPE'))
+        obs_file.write(header_line('synth_utils', 'PGM / RUN BY / DATE'))
+        obs_file.write(header_line(marker, 'MARKER NAME'))
+        obs_file.write(header_line('  -2700000.0000 -4300000.0000  3850000.0000', 'APPROX POSITION XYZ'))
+        for system in systems:
+            obs_file.write(header_line('%s  %3d %s' % (system, len(OBS_TYPES), ' '.join(OBS_TYPES)),
+                                       'SYS / # / OBS TYPES'))
+        obs_file.write(header_line('%10.3f' % (interval,), 'INTERVAL'))
+        obs_file.write(header_line('  %4d    %02d    %02d    %02d    %02d   %10.7f     GPS' % (start[:5] + (start[5],)),
+                                   'TIME OF FIRST OBS'))
+        obs_file.write(header_line('', 'END OF HEADER'))
+
+        for i in range(int(round(duration / interval))):
+            dt = i * interval
+            obs_file.write(epoch_line(t0 + dt, len(sats)))
+            for sat in sats:
+                rng = ranges[sat] + rates[sat] * dt
+                # each observation is followed by its loss of lock indicator and signal strength
+                lli = '1' if rand.random() < slip_rate else ' '
+                obs_file.write('%s%14.3f%s %14.3f  %14.3f  %14.3f  \n' % (sat, rng, lli,
+                    rng / 0.19029367, -rates[sat] / 0.19029367, rand.uniform(30.0, 50.0)))
+
+
+def write_nav_file(filename, num_systems=2, sats_per_system=8, start=(2017, 3, 15, 12, 0, 0)):
+    """Write a RINEX 3.03 navigation file with one (meaningless) ephemeris per satellite."""
+    with open(filename, 'w') as nav_file:
+        nav_file.write(header_line('     3.03           N: GNSS NAV DATA    M', 'RINEX VERSION / TYPE'))
+        nav_file.write(header_line('synth_utils', 'PGM / RUN BY / DATE'))
+        nav_file.write(header_line('', 'END OF HEADER'))
+        for system in SYSTEMS[:num_systems]:
+            for prn in range(1, sats_per_system + 1):
+                nav_file.write('%s%02d %4d %02d %02d %02d %02d %02d%s\n' % ((system, prn) + tuple(start) +
+                    (' 0.000000000000E+00' * 3,)))
+                for line in range(7):
+                    nav_file.write('    %s\n' % (' 0.000000000000E+00' * 4,))
+
+
+CONVBIN = '''
+# writes <name>.obs and <name>.nav in the -d directory, copying the "binary" file as the observations
+import os, shutil, sys, time
+args = sys.argv[1:]
+target_dir, binfile = args[args.index('-d') + 1], args[-1]
+time.sleep(%(convbin_seconds)r)
+name = os.path.splitext(os.path.basename(binfile))[0]
+shutil.copyfile(binfile, os.path.join(target_dir, name + '.obs'))
+shutil.copyfile(%(nav_file)r, os.path.join(target_dir, name + '.nav'))
+'''
+
+RNX2RTKP = '''
+# writes a solution in llh format with an epoch for each epoch of the rover observations between -ts and -te
+import random, sys, time
+options, files = {}, []
+args = iter(sys.argv[1:])
+for arg in args:
+    if arg in ('-ts', '-te'):
+        options[arg] = ' '.join([next(args), next(args)]).replace(':', ' ').replace('/', ' ').split()
+    elif arg in ('-k', '-o', '-ti'):
+        options[arg] = next(args)
+    else:
+        files.append(arg)
+sln_file, rover_obs = options['-o'], files[0]
+start = [float(v) for v in options.get('-ts', [0] * 6)]
+end = [float(v) for v in options.get('-te', [9999] + [0] * 5)]
+rand = random.Random(rover_obs + str(start))
+times = []
+with open(rover_obs) as obs_file:
+    in_header = True
+    for line in obs_file:
+        if in_header:
+            in_header = line[60:73] != 'END OF HEADER'
+        elif line.startswith('>'):
+            f = line[1:].split()
+            if start <= [float(v) for v in f[:6]] <= end:
+                times.append('%%s/%%s/%%s %%02d:%%02d:%%06.3f' %% (f[0], f[1], f[2], int(f[3]), int(f[4]), float(f[5])))
+time.sleep(%(rnx2rtkp_seconds)r + %(rnx2rtkp_seconds_per_epoch)r * len(times))
+with open(sln_file, 'w') as sln:
+    sln.write('%% program   : stub rnx2rtkp\\n')
+    sln.write('%%  GPST                  latitude(deg) longitude(deg)  height(m)   Q  ns\\n')
+    for t in times:
+        q = 1 if rand.random() < %(fix_ratio)r else 2
+        sln.write('%%s %%14.9f %%14.9f %%10.4f %%3d %%3d\\n' %% (t, 37.0 + rand.gauss(0, 1e-8),
+            -122.0 + rand.gauss(0, 1e-8), 10.0 + rand.gauss(0, 0.02), q, 12))
+'''
+
+RTKPLOT = '''
+# writes a blank image to the -s file
+import sys, time
+args = sys.argv[1:]
+plot_file = args[args.index('-s') + 1]
+time.sleep(%(rtkplot_seconds)r)
+try:
+    from PIL import Image
+    Image.new('RGB', (800, 600), 'white').save(plot_file, 'JPEG')
+except ImportError:
+    with open(plot_file, 'wb') as f:
+        f.write(b'\\xff\\xd8' + b'\\0' * 30000 + b'\\xff\\xd9')
+'''
+
+
+def write_stub_tools(bin_dir, convbin_seconds=0.5, rnx2rtkp_seconds=1.0, rnx2rtkp_seconds_per_epoch=0,
+                     rtkplot_seconds=0.5, fix_ratio=0.9, num_systems=2, sats_per_system=8):
+    """Write Python scripts named convbin.exe, rnx2rtkp.exe and rtkplot.exe into bin_dir.
+
+    They take the same arguments as the real tools, sleep for the given
+    times and write plausible outputs, so that the rest of the pipeline
+    can be timed without RTKLIB.  They run on POSIX systems only.
+    """
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    nav_file = os.path.abspath(os.path.join(bin_dir, 'stub.nav'))
+    write_nav_file(nav_file, num_systems, sats_per_system)
+    settings = {'convbin_seconds': convbin_seconds, 'rnx2rtkp_seconds': rnx2rtkp_seconds,
+                'rnx2rtkp_seconds_per_epoch': rnx2rtkp_seconds_per_epoch, 'rtkplot_seconds': rtkplot_seconds,
+                'fix_ratio': fix_ratio, 'nav_file': nav_file}
+    for name, source in (('convbin.exe', CONVBIN), ('rnx2rtkp.exe', RNX2RTKP), ('rtkplot.exe', RTKPLOT)):
+        exe_file = os.path.join(bin_dir, name)
+        with open(exe_file, 'w') as f:
+            f.write('#!%s\n' % (sys.executable,))
+            f.write(source % settings)
+        os.chmod(exe_file, os.stat(exe_file).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
@@ -0,0 +1,64 @@
+"""Tests of the gap detection of rinex_utils.
+
+Run with: python -m unittest test_rinex_utils
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import calendar
+import os
+import shutil
+import tempfile
+import unittest
+
+from rinex_utils import np, scan_obs_file, EpochIndex
+from synth_utils import header_line, epoch_line
+
+T0 = calendar.timegm((2017, 3, 15, 12, 0, 0))
+
+
+class GapTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'rover.obs')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write_obs(self, times):
+        with open(self.filename, 'w') as obs_file:
+            obs_file.write(header_line('', 'END OF HEADER'))
+            for seconds in times:
+                obs_file.write(epoch_line(seconds, 1))
+                obs_file.write('G01  20000000.000\n')
+
+    def gaps(self):
+        # gaps found by scan_obs_file, checked against EpochIndex when numpy is there
+        gaps = scan_obs_file(self.filename).gaps
+        if np is not None:
+            with EpochIndex(self.filename) as index:
+                self.assertEqual([tuple(gap) for gap in index.gaps().tolist()], gaps)
+        return gaps
+
+    def test_regular(self):
+        self.write_obs([T0 + i for i in range(100)])
+        self.assertEqual(self.gaps(), [])
+
+    def test_missing_epochs(self):
+        self.write_obs([T0 + i for i in range(100) if not 40 <= i < 45])
+        self.assertEqual(self.gaps(), [(T0 + 39, T0 + 45)])
+
+    def test_rate_change(self):
+        # ten 10 s intervals, then 1 s, so the early intervals are gaps by the median
+        self.write_obs([T0 + 10 * i for i in range(11)] + [T0 + 100 + i for i in range(1, 200)])
+        self.assertEqual(self.gaps(), [(T0 + 10 * i, T0 + 10 * (i + 1)) for i in range(10)])
+
+    def test_empty(self):
+        open(self.filename, 'w').close()
+        self.assertEqual(self.gaps(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+"""Keep the runs/ directory from growing without bound.
+
+Recently finished jobs keep their directories.  Older ones are packed into
+one compressed archive each, and once the disk fills past a high-water
+mark the oldest archives, and then the oldest directories, are deleted.
+Jobs in progress can be given directories on a tmpfs, which are moved to
+runs/ once they are done.
+"""
+
+# Copyright (C) 2017 Jeff Everett - All Rights Reserved
+# You may use, distribute and modify this code under the
+# terms of the BSD-2-Clause license
+
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+from my_constants import (CACHE_DIR, WORKSPACE_HOT_DAYS, WORKSPACE_KEEP, WORKSPACE_RESULT_EXTS,
+    WORKSPACE_HIGH_WATER, WORKSPACE_LOW_WATER, WORKSPACE_MAX_BYTES, WORKSPACE_TMPFS, WORKSPACE_TMPFS_MIN_FREE,
+    WORKSPACE_CHECK_INTERVAL)
+
+
+def tree_size(path):
+    # bytes of the files under path
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except os.error:
+                pass
+    return total
+
+
+class Workspace(object):
+    """Directories of jobs under root, and archives of old ones under root/archive.
+
+    Args:
+      root: Directory holding a directory for each job.
+      tmpfs: Directory on a tmpfs for jobs in progress, or None.
+    """
+    def __init__(self, root='runs', tmpfs=WORKSPACE_TMPFS):
+        self.root = root
+        self.tmpfs = tmpfs
+        self.archive_dir = os.path.join(root, 'archive')
+        # directories under root which do not belong to a job
+        self.reserved = set(['archive', os.path.basename(os.path.normpath(CACHE_DIR))])
+        self.lock = threading.Lock()
+        self.last_check = 0
+        self.thread = None
+
+    def job_dir(self, msg_id):
+        """Returns the directory of a job, creating it if needed.
+
+        New directories go on the tmpfs if there is one with at least
+        WORKSPACE_TMPFS_MIN_FREE bytes free.
+        """
+        with self.lock:
+            for parent in ([self.tmpfs] if self.tmpfs else []) + [self.root]:
+                dirname = os.path.join(parent, msg_id)
+                if os.path.isdir(dirname):
+                    return dirname
+            parent = self.root
+            if self.tmpfs and os.path.isdir(self.tmpfs) and \
+                    shutil.disk_usage(self.tmpfs).free > WORKSPACE_TMPFS_MIN_FREE:
+                parent = self.tmpfs
+            dirname = os.path.join(parent, msg_id)
+            os.makedirs(dirname)
+            return dirname
+
+    def finish(self, msg_id):
+        """Move the directory of a finished job from the tmpfs to root."""
+        if not self.tmpfs:
+            return
+        with self.lock:
+            dirname = os.path.join(self.tmpfs, msg_id)
+            if os.path.isdir(dirname):
+                target = os.path.join(self.root, msg_id)
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                shutil.move(dirname, target)
+
+    def job_dirs(self):
+        # (mtime, msg_id) of the directories of jobs under root, oldest first
+        dirs = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and entry.name not in self.reserved:
+                dirs.append((entry.stat().st_mtime, entry.name))
+        return sorted(dirs)
+
+    def archives(self):
+        # (mtime, path) of the archives, oldest first
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(self.archive_dir)
+                      if entry.is_file())
+
+    def archive(self, msg_id):
+        """Pack the directory of a job into archive/<msg_id>.tar.gz and delete it.
+
+        With WORKSPACE_KEEP 'results', only the files ending in one of
+        WORKSPACE_RESULT_EXTS are kept.
+        """
+        dirname = os.path.join(self.root, msg_id)
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        archive_file = os.path.join(self.archive_dir, msg_id + '.tar.gz')
+        tmp_file = archive_file + '.tmp'
+        with tarfile.open(tmp_file, 'w:gz') as tar:
+            for dirpath, dirnames, filenames in os.walk(dirname):
+                for filename in sorted(filenames):
+                    if WORKSPACE_KEEP == 'results' and not filename.lower().endswith(WORKSPACE_RESULT_EXTS):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    tar.add(path, os.path.relpath(path, self.root))
+        os.replace(tmp_file, archive_file)
+        shutil.rmtree(dirname)
+
+    def maintain(self, can_remove):
+        """Archive the directories of jobs finished more than WORKSPACE_HOT_DAYS
+        ago, then delete the oldest archives and directories while the disk (or
+        root, if WORKSPACE_MAX_BYTES is set) is fuller than WORKSPACE_HIGH_WATER,
+        until it is no fuller than WORKSPACE_LOW_WATER.
+
+        Args:
+          can_remove: Function returning whether the job with a message id
+            is finished, so that its directory can be archived or deleted.
+        """
+        if not os.path.isdir(self.root):
+            return
+        cutoff = time.time() - WORKSPACE_HOT_DAYS * 86400
+        for mtime, msg_id in self.job_dirs():
+            if mtime < cutoff and can_remove(msg_id):
+                print('Archiving run %s.' % (msg_id,))
+                self.archive(msg_id)
+
+        disk = shutil.disk_usage(self.root)
+        used = disk.used
+        size = tree_size(self.root) if WORKSPACE_MAX_BYTES else 0
+        def full(water):
+            # water is a fraction of the disk; WORKSPACE_MAX_BYTES counts as the high-water mark of root
+            return (used > water * disk.total or
+                    (WORKSPACE_MAX_BYTES and size > water / WORKSPACE_HIGH_WATER * WORKSPACE_MAX_BYTES))
+        if not full(WORKSPACE_HIGH_WATER):
+            return
+        victims = [path for _, path in self.archives()]
+        victims += [os.path.join(self.root, msg_id) for _, msg_id in self.job_dirs() if can_remove(msg_id)]
+        for path in victims:
+            if not full(WORKSPACE_LOW_WATER):
+                break
+            print('Disk is nearly full, deleting %s.' % (path,))
+            if os.path.isdir(path):
+                freed = tree_size(path)
+                shutil.rmtree(path)
+            else:
+                freed = os.path.getsize(path)
+                os.remove(path)
+            used -= freed
+            size -= freed
+
+    def maintain_in_background(self, can_remove):
+        """Start maintain on a thread of its own, if it is due and not already running."""
+        if time.time() - self.last_check < WORKSPACE_CHECK_INTERVAL:
+            return
+        if self.thread and self.thread.is_alive():
+            return
+        self.last_check = time.time()
+        def run():
+            try:
+                self.maintain(can_remove)
+            except Exception as e:
+                print('Failed to tidy up %s. Error: %s.' % (self.root, e))
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()